@@ -0,0 +1,541 @@
+#!/usr/bin/python3
+
+# -*- coding: utf-8 -*-
+# vim: tw = 0
+# vim: set fileencoding = utf-8
+
+"""
+Benchmarks for the generator: micro-benchmarks of the internals, and full
+pipeline runs on synthetic Franca corpora of scalable size
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import pyfranca_cpp
+from pyfranca import ast
+
+
+def synthetic_types(count, max_references=3, seed=1):
+    """create a list of type names and a dependency index between them
+       Every type only references types with a higher number, so the graph
+       has no cycles, and the types are listed in the worst order (every
+       referenced type comes after its referencer).
+
+    Args:
+        count (int): number of types
+        max_references (int, optional): references per type. Defaults to 3.
+        seed (int, optional): random seed. Defaults to 1.
+
+    Returns:
+        tuple: (list of (name, text) tuples, pyfranca_cpp.DependencyIndex)
+    """
+    rng = random.Random(seed)
+    names = [f"Type{idx}" for idx in range(count)]
+    index = pyfranca_cpp.DependencyIndex()
+    for idx, name in enumerate(names):
+        if idx + 1 < count:
+            # a long chain, plus a few random forward references
+            index.add(name, names[idx + 1])
+            for _ in range(rng.randint(0, max_references - 1)):
+                index.add(name, names[rng.randrange(idx + 1, count)])
+        # built-in types are referenced too but never rendered
+        index.add(name, "UInt32")
+    return [(name, f"struct {name} {{}};\n") for name in names], index
+
+
+def bench_reorder_types(sizes, repeat):
+    """time reorder_types() for growing numbers of types
+
+    Args:
+        sizes (list): type counts to measure
+        repeat (int): runs per size, the best one is reported
+    """
+    print(f"{'types':>8} {'references':>11} {'best [ms]':>10} {'per type [us]':>14}")
+    for count in sizes:
+        types, index = synthetic_types(count)
+        references = sum(len(referenced) for referenced in index.forward.values())
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            pyfranca_cpp.reorder_types(types, index)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{count:>8} {references:>11} {best * 1e3:>10.2f} {best / count * 1e6:>14.2f}")
+
+
+def synthetic_type_collection(count):
+    """create the AST of a type collection with many types, without parsing
+       Structs reference the previous struct, so the types header also has
+       to be reordered.
+
+    Args:
+        count (int): number of types
+
+    Returns:
+        tuple: (ast.Package, ast.TypeCollection)
+    """
+    members = []
+    previous = None
+    for idx in range(count):
+        if idx % 10 == 9:
+            members.append(ast.Typedef(f"Handle{idx}", ast.UInt32()))
+            continue
+        fields = OrderedDict()
+        fields['id'] = ast.StructField('id', ast.UInt32())
+        fields['name'] = ast.StructField('name', ast.String())
+        if previous is not None:
+            reference = ast.Reference(previous.name)
+            reference.reference = previous
+            fields['parent'] = ast.StructField('parent', reference)
+        previous = ast.Struct(f"Struct{idx}", fields)
+        members.append(previous)
+    type_collection = ast.TypeCollection("Synthetic", members=members)
+    package = ast.Package("org.bench", typecollections=OrderedDict(Synthetic=type_collection))
+    return package, type_collection
+
+
+def bench_render_types(count):
+    """render the types header of a large type collection, measuring time
+       and peak memory compared to the size of the result
+
+    Args:
+        count (int): number of types
+    """
+    package, type_collection = synthetic_type_collection(count)
+    generator = pyfranca_cpp.Generator(sink=pyfranca_cpp.MemorySink())
+    generator.env.get_template('typesheader.tpl')    # compile templates outside the measurement
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    job = pyfranca_cpp.GenerationJob("synthetic.fidl")
+    with generator.activate():
+        result = pyfranca_cpp.template_render_complex_types(job, package, type_collection, [])
+    elapsed = time.perf_counter() - start
+    del job
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    size = len(result)
+    print(f"rendered {count} types in {elapsed:.2f} s: {size / 1e6:.1f} MB of text, "
+          f"peak {peak / 1e6:.1f} MB traced ({peak / size:.1f}x the result)")
+
+
+# Peak memory budget of a low-memory run, see check_memory_budget(): a
+# corpus of large type collections (about 15000 types), every type
+# collection and interface is an input
+MEMORY_BUDGET_SCENARIO = dict(type_collections=5, interfaces=3, methods=50, structs=2000,
+                              chain=50, arrays=700, maps=300, imports=1)
+MEMORY_BUDGET_MB = 40          # a normal run of it peaks at about 65 MB
+
+
+def check_memory_budget(budget_mb, settings=MEMORY_BUDGET_SCENARIO, low_memory=True):
+    """generate a corpus of large type collections in low-memory mode,
+       checking the peak traced by tracemalloc against a budget
+       The run goes through Generator.generate(), so the per-file writes,
+       the dropped outputs and the models that are not kept are measured.
+       The generated files are kept in a MemorySink, they are part of the
+       peak.
+
+    Args:
+        budget_mb (float): allowed peak in MB
+        settings (dict, optional): write_corpus() arguments. Defaults to MEMORY_BUDGET_SCENARIO.
+        low_memory (bool, optional): False to compare with a normal run. Defaults to True.
+
+    Returns:
+        bool: True if the run had no errors and the peak stayed within the budget
+    """
+    with tempfile.TemporaryDirectory(prefix="pyfranca_cpp_bench") as work_dir:
+        fidl_dir = os.path.join(work_dir, "fidl")
+        interfaces = write_corpus(fidl_dir, **settings)
+        files = [os.path.join(fidl_dir, f"types{idx}.fidl")
+                 for idx in range(settings['type_collections'])] + interfaces
+        sink = pyfranca_cpp.MemorySink()
+        generator = pyfranca_cpp.Generator(os.path.join(work_dir, "src_gen"), formatter='none',
+                                           low_memory=low_memory, sink=sink)
+        # Compile the templates outside the measurement
+        for name in generator.template_loader.list_templates():
+            if name.endswith('.tpl'):
+                generator.env.get_template(name)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        jobs = generator.generate(files)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    size = sum(len(content) for content in sink.files.values())
+    errors = sum(len(job.errors) for job in jobs)
+    within = peak <= budget_mb * 1e6 and not errors
+    print(f"{len(files)} files in {elapsed:.2f} s{'' if low_memory else ' (not low-memory)'}: "
+          f"{size / 1e6:.1f} MB of text, {errors} errors, peak {peak / 1e6:.1f} MB traced, "
+          f"budget {budget_mb:.0f} MB: {'OK' if within else 'EXCEEDED'}")
+    return within
+
+
+# ----- Synthetic corpora -----
+# Scenarios for the full pipeline.  Counts are per type collection /
+# interface, 'chain' is the depth of a struct reference chain in every type
+# collection and 'imports' the number of type collections each interface
+# imports.
+
+SCENARIOS = OrderedDict([
+    ('small', dict(type_collections=2, interfaces=5, methods=5, structs=10,
+                   chain=3, arrays=3, maps=2, imports=1)),
+    ('medium', dict(type_collections=10, interfaces=40, methods=15, structs=40,
+                    chain=10, arrays=10, maps=5, imports=3)),
+    ('large', dict(type_collections=20, interfaces=150, methods=30, structs=150,
+                   chain=40, arrays=30, maps=15, imports=5)),
+])
+
+
+def type_collection_fidl(idx, structs, chain, arrays, maps):
+    """FIDL text of a synthetic type collection
+
+    Args:
+        idx (int): number of the type collection, used in all names
+        structs (int): number of independent structs
+        chain (int): depth of a chain of structs, each containing the next
+        arrays (int): number of arrays
+        maps (int): number of maps
+
+    Returns:
+        string: FIDL text
+    """
+    prefix = f"T{idx}"
+    lines = [f"package bench.types{idx}", "",
+             f"typeCollection Types{idx} {{",
+             "    version { major 1 minor 0 }", ""]
+    lines += [f"    enumeration {prefix}Kind {{", "        FIRST = 1", "        SECOND", "    }", ""]
+    for number in range(structs):
+        lines += [f"    <** @description: struct {number} **>",
+                  f"    struct {prefix}S{number} {{",
+                  "        UInt32 id", "        String name", f"        {prefix}Kind kind",
+                  "        Double[] values", "    }", ""]
+    # Listed from the outermost struct to the innermost one, so the types
+    # have to be reordered
+    for depth in range(chain):
+        inner = f"{prefix}C{depth + 1}" if depth + 1 < chain else "UInt8"
+        lines += [f"    struct {prefix}C{depth} {{", f"        {inner} inner", "        Int32 level", "    }", ""]
+    for number in range(arrays):
+        element = f"{prefix}S{number % structs}" if structs else "UInt16"
+        lines += [f"    array {prefix}A{number} of {element}", ""]
+    for number in range(maps):
+        value = f"{prefix}S{number % structs}" if structs else "String"
+        lines += [f"    map {prefix}M{number} {{", f"        UInt32 to {value}", "    }", ""]
+    lines += ["}", ""]
+    return "\n".join(lines)
+
+
+def interface_fidl(idx, methods, imported, structs, arrays):
+    """FIDL text of a synthetic interface
+
+    Args:
+        idx (int): number of the interface, used in all names
+        methods (int): number of methods
+        imported (list): numbers of the imported type collections
+        structs (int): structs per type collection
+        arrays (int): arrays per type collection
+
+    Returns:
+        string: FIDL text
+    """
+    lines = [f"package bench.iface{idx}", ""]
+    lines += [f'import bench.types{number}.Types{number}.* from "types{number}.fidl"' for number in imported]
+    lines += ["", f"interface Iface{idx} {{", "    version { major 1 minor 0 }", ""]
+    lines += [f"    struct Local{idx} {{", "        UInt32 handle", "        String label", "    }", ""]
+    for number in range(methods):
+        source = imported[number % len(imported)] if imported else None
+        in_type = f"T{source}S{number % structs}" if source is not None and structs else "UInt32"
+        out_type = f"T{source}A{number % arrays}" if source is not None and arrays else "String"
+        lines += [f"    <** @description: method {number} **>",
+                  f"    method call{number} {{",
+                  "        in {", f"            {in_type} request", f"            Local{idx} context",
+                  "            Boolean flag", "        }",
+                  "        out {", f"            {out_type} response", "            Int32[] codes", "        }",
+                  "    }", ""]
+    lines += ["}", ""]
+    return "\n".join(lines)
+
+
+def write_corpus(target_dir, type_collections, interfaces, methods, structs, chain,
+                 arrays, maps, imports):
+    """write a synthetic Franca corpus
+
+    Args:
+        target_dir (filePath): dir for the FIDL files
+        type_collections (int): number of type collection files
+        interfaces (int): number of interface files
+        methods (int): methods per interface
+        structs (int): structs per type collection
+        chain (int): depth of the struct reference chain per type collection
+        arrays (int): arrays per type collection
+        maps (int): maps per type collection
+        imports (int): type collections imported by each interface
+
+    Returns:
+        list: paths of the interface files, the inputs of the generator
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    for idx in range(type_collections):
+        with open(os.path.join(target_dir, f"types{idx}.fidl"), 'w', encoding="utf8") as out_file:
+            out_file.write(type_collection_fidl(idx, structs, chain, arrays, maps))
+
+    files = []
+    for idx in range(interfaces):
+        imported = sorted({(idx + offset) % type_collections
+                           for offset in range(min(imports, type_collections))})
+        path = os.path.join(target_dir, f"iface{idx}.fidl")
+        with open(path, 'w', encoding="utf8") as out_file:
+            out_file.write(interface_fidl(idx, methods, imported, structs, arrays))
+        files.append(path)
+    return files
+
+
+def run_scenario(settings, jobs, formatter='none', pipeline=False):
+    """generate a corpus and run the whole pipeline on it
+       Meant to run in a fresh process, so that the peak RSS belongs to this
+       scenario only.  By default clang-format is not run (formatter 'none'),
+       its cost would dominate and doesn't depend on this project.
+
+    Args:
+        settings (dict): corpus size, see SCENARIOS
+        jobs (int): worker processes for the generator
+        formatter (string, optional): one of FORMATTERS. Defaults to 'none'.
+        pipeline (bool, optional): pipelined mode. Defaults to False.
+
+    Returns:
+        dict: wall time, peak RSS and stage totals
+    """
+    with tempfile.TemporaryDirectory(prefix="pyfranca_cpp_bench") as work_dir:
+        files = write_corpus(os.path.join(work_dir, "fidl"), **settings)
+        generator = pyfranca_cpp.Generator(os.path.join(work_dir, "src_gen"), formatter=formatter, jobs=jobs,
+                                           pipeline=pipeline)
+
+        report = pyfranca_cpp.TimingReport()
+        start = time.perf_counter()
+        results = generator.generate(files, Counter(), report)
+        wall_time = time.perf_counter() - start
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'settings': settings,
+        'jobs': jobs,
+        'files': len(files),
+        'errors': sum(len(job.errors) for job in results),
+        'wall_time': wall_time,
+        # ru_maxrss is in kB on Linux
+        'peak_rss_kb': max(usage.ru_maxrss, children.ru_maxrss),
+        'stages': {stage: entry['seconds'] for stage, entry in report.as_dict()['totals'].items()},
+    }
+
+
+def git_revision():
+    """current git commit of the project, if available"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_corpus(names, jobs, quiet=True, formatter='none', pipeline=False):
+    """run scenarios, each in its own process
+
+    Args:
+        names (list): scenario names from SCENARIOS
+        jobs (int): worker processes for the generator
+        quiet (bool, optional): hide the generator output. Defaults to True.
+        formatter (string, optional): one of FORMATTERS. Defaults to 'none'.
+        pipeline (bool, optional): pipelined mode. Defaults to False.
+
+    Returns:
+        dict: results in baseline format
+    """
+    results = {'revision': git_revision(), 'python': sys.version.split()[0], 'scenarios': {}}
+    for name in names:
+        with open(os.devnull, 'w', encoding="utf8") as devnull:
+            stdout = sys.stdout
+            if quiet:
+                sys.stdout = devnull
+            try:
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    result = pool.submit(run_scenario, SCENARIOS[name], jobs, formatter, pipeline).result()
+            finally:
+                sys.stdout = stdout
+        results['scenarios'][name] = result
+        print(f"{name:>8}: {result['files']:>4} files, {result['wall_time']:>7.2f} s, "
+              f"peak RSS {result['peak_rss_kb'] / 1024:>7.1f} MB, {result['errors']} errors")
+        slowest = sorted(result['stages'].items(), key=lambda item: -item[1])
+        print("          " + ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in slowest[:5]))
+    return results
+
+
+def tree_contents(root):
+    """read all files below a dir
+
+    Args:
+        root (filePath): dir to read
+
+    Returns:
+        dict: relative path -> bytes
+    """
+    contents = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as in_file:
+                contents[os.path.relpath(path, root)] = in_file.read()
+    return contents
+
+
+def check_reproducible(names, jobs):
+    """generate each corpus twice with --reproducible, in fresh processes
+       with different hash seeds and job counts, and compare the trees
+       byte by byte
+
+    Args:
+        names (list): scenario names from SCENARIOS
+        jobs (int): worker processes for the second run
+
+    Returns:
+        bool: True if all trees were identical
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pyfranca_cpp.py")
+    identical = True
+    for name in names:
+        with tempfile.TemporaryDirectory(prefix="pyfranca_cpp_bench") as work_dir:
+            files = write_corpus(os.path.join(work_dir, "fidl"), **SCENARIOS[name])
+            trees = []
+            for run, (seed, run_jobs) in enumerate(((1, 1), (2, max(jobs, 2)))):
+                out_dir = os.path.join(work_dir, f"src_gen{run}")
+                environ = dict(os.environ, PYTHONHASHSEED=str(seed))
+                environ.pop('SOURCE_DATE_EPOCH', None)
+                subprocess.run([sys.executable, script, '--reproducible', '--no-cache',
+                                '--formatter', 'none', '-j', str(run_jobs), '-o', out_dir] + files,
+                               env=environ, cwd=work_dir, check=True, stdout=subprocess.DEVNULL)
+                trees.append(tree_contents(out_dir))
+
+        differing = sorted(path for path in trees[0].keys() | trees[1].keys()
+                           if trees[0].get(path) != trees[1].get(path))
+        if differing:
+            identical = False
+            print(f"{name:>8}: {len(differing)} of {len(trees[0])} files differ, "
+                  f"e.g. {', '.join(differing[:5])}")
+        else:
+            print(f"{name:>8}: {len(trees[0])} files, byte-identical")
+    return identical
+
+
+def compare_baseline(results, baseline, threshold):
+    """compare results with a stored baseline
+
+    Args:
+        results (dict): current results
+        baseline (dict): earlier results
+        threshold (float): relative increase reported as regression, e.g. 0.1
+
+    Returns:
+        bool: True if some scenario regressed
+    """
+    regressed = False
+    print(f"compared to baseline from revision {baseline.get('revision')}:")
+    for name, result in results['scenarios'].items():
+        old = baseline['scenarios'].get(name)
+        if old is None:
+            continue
+        for metric in ('wall_time', 'peak_rss_kb'):
+            change = result[metric] / old[metric] - 1 if old[metric] else 0.0
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                regressed = True
+            print(f"{name:>8} {metric:>12}: {old[metric]:>10.2f} -> {result[metric]:>10.2f} "
+                  f"({change:+.1%}){flag}")
+    return regressed
+
+
+def main():
+    """main function
+
+    Returns:
+        int: exit status
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sizes', default="250,500,1000,2000,4000,8000,16000",
+                        help="comma separated type counts for reorder_types()")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="runs per size, the fastest is reported")
+    parser.add_argument('--render-types', type=int, default=10000,
+                        help="size of the synthetic type collection to render, 0 to skip")
+    parser.add_argument('--corpus', metavar='NAMES',
+                        help=f"run the full pipeline on synthetic corpora instead, comma "
+                        f"separated from: {', '.join(SCENARIOS)}")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="worker processes for the corpus runs")
+    parser.add_argument('--formatter', choices=pyfranca_cpp.FORMATTERS, default='none',
+                        help="formatter for --corpus (default: none, clang-format would dominate)")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="run the --corpus scenarios in pipelined mode")
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help="store the corpus results as baseline")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare the corpus results with a stored baseline")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="relative slowdown / growth reported as regression (default: 0.1)")
+    parser.add_argument('--check-reproducible', action='store_true',
+                        help="instead of timing, check that two --reproducible runs on "
+                        "the --corpus scenarios give byte-identical output")
+    parser.add_argument('--check-memory', action='store_true',
+                        help="generate a corpus of about 15000 types in low-memory mode and exit "
+                        "with 1 if the traced peak exceeds --memory-budget")
+    parser.add_argument('--memory-budget', type=float, default=MEMORY_BUDGET_MB, metavar='MB',
+                        help=f"peak memory budget for --check-memory (default: {MEMORY_BUDGET_MB})")
+    parser.add_argument('--write-corpus', metavar='DIR',
+                        help="only write the FIDL files of the --corpus scenario to DIR")
+    args = parser.parse_args()
+
+    if args.corpus:
+        names = args.corpus.split(",")
+        for name in names:
+            if name not in SCENARIOS:
+                parser.error(f"unknown scenario '{name}'")
+        if args.write_corpus:
+            write_corpus(args.write_corpus, **SCENARIOS[names[0]])
+            return 0
+        if args.check_reproducible:
+            return 0 if check_reproducible(names, args.jobs) else 1
+
+        results = bench_corpus(names, args.jobs, formatter=args.formatter, pipeline=args.pipeline)
+        if args.save_baseline:
+            with open(args.save_baseline, 'w', encoding="utf8") as out_file:
+                json.dump(results, out_file, indent=1, sort_keys=True)
+        if args.compare:
+            with open(args.compare, 'r', encoding="utf8") as in_file:
+                if compare_baseline(results, json.load(in_file), args.threshold):
+                    return 1
+        return 0
+
+    if args.check_memory:
+        return 0 if check_memory_budget(args.memory_budget) else 1
+
+    bench_reorder_types([int(size) for size in args.sizes.split(",")], args.repeat)
+    if args.render_types:
+        bench_render_types(args.render_types)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,6 +11,22 @@ Generate stuff from Franca IDL based on templates
 import sys
 import os
 import time
+import heapq
+import glob
+import argparse
+import contextlib
+import contextvars
+import functools
+import hashlib
+import io
+import json
+import pickle
+import queue
+import re
+import shutil
+import tempfile
+import threading
+from collections import Counter, OrderedDict, deque
 from itertools import *
 
 # call, POpen, ...
@@ -25,100 +41,337 @@ sys.path.append(os.getcwd() + "/../pyfranca")
 sys.path.append(os.getcwd() + "/jinja/src")
 sys.path.append(os.getcwd() + "/../jinja/src")
 
-from pyfranca import Processor, LexerException, ParserException, ProcessorException, ast
-from pyfranca.ast import Array
-from jinja2 import Environment, BaseLoader, TemplateNotFound
+@functools.lru_cache(maxsize=None)
+def backend():
+    """the parts built on pyfranca and jinja2 (pyfranca_cpp_backend.py),
+       imported on first use: importing both takes most of the start-up time
 
-# From jinja2 docs
+    Returns:
+        module: pyfranca_cpp_backend
+    """
+    import pyfranca_cpp_backend
+    return pyfranca_cpp_backend
+
+# -------------------------------------------------------------------
+# Setting up...
+# Constants and other global values
+
+
+RELATIVE_OUTPUT_DIR = 'src_gen'
+
+# Part of the build cache key, increase when the generated output changes
+GENERATOR_VERSION = "0.2"
+
+# Build cache file, relative to the output dir
+BUILD_CACHE_FILE = '.pyfranca_cpp_cache.json'
+BUILD_CACHE_FORMAT = 2      # entries with per output template dependencies
+
+# Read by boilerplate_from_file(), every output depends on it
+BOILERPLATE_FILE = 'boilerplate.txt'
+
+# Compiled templates kept in memory
+TEMPLATE_CACHE_SIZE = 100
+
+# Digest of the templates a precompiled template dir was built from
+TEMPLATE_CACHE_MANIFEST = 'templates.sha256'
+
+# Profiling
+PROFILE_MEMORY_FRAMES = 10          # traceback depth recorded by tracemalloc
+PROFILE_MEMORY_TOP = 30             # allocation sites listed in the report
+
+# Code formatting
+FORMATTERS = ('auto', 'clang-format', 'python', 'none')
+CLANG_FORMAT_BATCH_SIZE = 100       # files per clang-format call
+FORMAT_INDENT_WIDTH = 4             # same as in .clang-format
+FORMAT_ACCESS_MODIFIER_OFFSET = -2
+
+# Pipelined mode: jobs whose outputs may wait for formatting and writing,
+# also the files in flight in worker processes
+PIPELINE_QUEUE_SIZE = 16
+
+# Stands for the body of a types header while the header template is rendered
+TYPES_BODY_PLACEHOLDER = "\0pyfranca_cpp types body\0"
+
+# Timestamp in the generated files, see generation_timestamp()
+TIMESTAMP_FORMAT = "%Y-%m-%d, %H:%M:%S"
+
+# Output kinds that can be selected with --targets.  Every kind is
+# rendered from a template for each namespace of the listed kinds
+# ('interfaces', 'typecollections') into <prefix><name><suffix>.  The
+# types header has no template of its own, it is assembled from the type
+# templates by render_typedef_file().
+OUTPUT_KINDS = {
+    'interface': {'template': 'interfaceheader.tpl', 'prefix': 'i', 'suffix': '.h',
+                  'namespaces': ['interfaces']},
+    'header': {'template': 'classheader.tpl', 'prefix': '', 'suffix': '.h',
+               'namespaces': ['interfaces']},
+    'source': {'template': 'class.tpl', 'prefix': '', 'suffix': '.cpp',
+               'namespaces': ['interfaces']},
+    'mock': {'template': 'unittest.tpl', 'prefix': 'utest_', 'suffix': '_mock.h',
+             'namespaces': ['interfaces']},
+    'types': {'template': None, 'prefix': '', 'suffix': '.types.h',
+              'namespaces': ['interfaces', 'typecollections']},
+}
+DEFAULT_TARGETS = tuple(OUTPUT_KINDS)
+
+# Members of a namespace that are rendered into its types header
+TYPE_KINDS = ('structs', 'unions', 'enumerations', 'typedefs', 'arrays', 'maps')
+
+# Where the default templates are installed.  Everything that depends on
+# the configuration (template environment, caches, output dir) belongs to
+# a Generator, see active_generator().
+basedir = os.path.dirname(os.path.realpath(__file__))
+
+# ---------------------------------------------------------------
+
+
+def log(*kwargs):
+    """log to commandline
+    """
+    print(", ".join(kwargs))
 
 
-class MyLoader(BaseLoader):
-    """load the templates
+@contextlib.contextmanager
+def timed(timings, stage):
+    """measure the time spent in a block and add it to timings[stage]
 
     Args:
-        BaseLoader (baseLoader): jinja baseLoader
+        timings (dict): stage -> {'seconds': float, 'calls': int}
+        stage (string): name of the stage
     """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = timings.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+        entry['seconds'] += time.perf_counter() - start
+        entry['calls'] += 1
 
-    def __init__(self, prioritydir, defaultdir, relpath):
-        self.relpath = relpath
-        self.prioritydir = prioritydir  # Use file from here, if it exists
-        self.defaultdir = defaultdir    # else from here.
 
-    def get_source(self, environment, template):
-        path = self.get_file_location(template)
+def clang_format(files):
+    """run clang-format in place on the given files
+       The files are passed in batches, so only a few processes are started
+       even for large runs.
 
-        if not os.path.exists(path):
-            raise TemplateNotFound(template)
+    Args:
+        files (list): files to format
+    """
+    for idx in range(0, len(files), CLANG_FORMAT_BATCH_SIZE):
+        call(['clang-format', '-i'] + files[idx:idx + CLANG_FORMAT_BATCH_SIZE])
 
-        mtime = os.path.getmtime(path)
-        with open(path, encoding='utf-8') as in_file:
-            source = in_file.read()
-        return source, path, lambda: mtime == os.path.getmtime(path)
 
-    def get_file_location(self, name):
-        """get the location of the file, when the full name is given
+def clang_format_stdin(content, path):
+    """run clang-format on content fed through stdin, no file is written
 
-        Args:
-            name (string): full path to file
+    Args:
+        content (string): generated content
+        path (filePath): where the file would be, clang-format looks for
+            its .clang-format file from there
 
-        Returns:
-            string: directory of the given file
-        """
-        preferred = os.path.abspath(os.path.join(self.prioritydir, self.relpath, name))
-        fallback = os.path.abspath(os.path.join(self.defaultdir, self.relpath, name))
+    Returns:
+        string: formatted content
+    """
+    return run(['clang-format', f'--assume-filename={path}'], input=content,
+               capture_output=True, encoding="utf8", check=True).stdout
 
-        if os.path.exists(preferred):
-            path = preferred
-        else:
-            path = fallback
-        return path
 
-# -------------------------------------------------------------------
-# Setting up...
-# Constants and other global values
+def python_format(content):
+    """Simple formatter for machines without clang-format.
+       It only re-indents by brace depth, joins the parameter lists the
+       templates spread over several lines and squeezes blank lines, which
+       is enough to get readable output.  It's no replacement for
+       clang-format.
 
+    Args:
+        content (string): C/C++ source
 
-RELATIVE_OUTPUT_DIR = 'src_gen'
+    Returns:
+        string: formatted source
+    """
+    lines = []
+    depth = 0
+    pending = ""
+    # code directly after the end of a comment goes to its own line
+    content = re.sub(r"\*/[ \t]*(?=\S)", "*/\n", content)
+    for line in content.splitlines():
+        stripped = pending + " " + line.strip() if pending else line.strip()
+        is_comment = stripped.startswith(("//", "/*", "*"))
+        if not is_comment and stripped.count("(") > stripped.count(")"):
+            pending = stripped
+            continue
+        pending = ""
+        if "(" in stripped and not is_comment:
+            stripped = re.sub(r"\(\s+", "(", stripped)
+            stripped = re.sub(r"\s+([),])", r"\1", stripped)
+            stripped = re.sub(r"(\w) \(", r"\1(", stripped)
+
+        if not stripped:
+            if lines and lines[-1] != "" and not lines[-1].endswith("{"):
+                lines.append("")
+            continue
+        if stripped.startswith("}") and lines and lines[-1] == "":
+            lines.pop()
+
+        indent = max(depth - 1 if stripped.startswith("}") else depth, 0) * FORMAT_INDENT_WIDTH
+        if re.match(r"(public|protected|private)\s*:", stripped):
+            indent = max(indent + FORMAT_ACCESS_MODIFIER_OFFSET, 0)
+        elif stripped.startswith("*"):
+            indent += 1     # continued block comment
+        lines.append(" " * indent + stripped)
+        if not is_comment:
+            depth = max(depth + stripped.count("{") - stripped.count("}"), 0)
+
+    while lines and lines[-1] == "":
+        lines.pop()
+    return "\n".join(lines) + "\n"
+
+
+def resolve_formatter(formatter):
+    """pick the formatter to use
 
-# The starting directory (assumed to be == the script directory for now)
-workingdir = os.getcwd()
-basedir = os.path.dirname(os.path.realpath(__file__))
-output_dir = workingdir + "/" + RELATIVE_OUTPUT_DIR
+    Args:
+        formatter (string): one of FORMATTERS
 
+    Returns:
+        string: 'auto' resolved to 'clang-format' if installed, else 'python'
+    """
+    if formatter == 'auto':
+        return 'clang-format' if shutil.which('clang-format') else 'python'
+    return formatter
 
-# Where to find templates
-env = Environment(
-    loader=MyLoader(workingdir,  # preferred/override location
-                    basedir,      # fallback/default location
-                    'templates')  # relative path
-)
 
-# ---------------------------------------------------------------
+def format_output(file_name, content, formatter, path, report):
+    """format one generated file and apply clean() to it, clang-format
+       gets the content through stdin
 
+    Args:
+        file_name (string): output file name, for the report
+        content (string): generated content
+        formatter (string): one of FORMATTERS, resolved
+        path (filePath): where the file would be, see clang_format_stdin()
+        report (TimingReport): collects stage timings
 
-def log(*kwargs):
-    """log to commandline
+    Returns:
+        string: final content
     """
-    print(", ".join(kwargs))
+    if formatter == 'clang-format':
+        with report.stage(file_name, 'clang_format'):
+            content = clang_format_stdin(content, path)
+    elif formatter == 'python':
+        with report.stage(file_name, 'python_format'):
+            # The lines clean() splits have to be indented, too
+            content = python_format(clean(content))
+    with report.stage(file_name, 'clean'):
+        return clean(content)
+
+
+def format_outputs(outputs, formatter, report=None, stdin=False):
+    """format all generated files of a run and apply clean() to them
+       For clang-format, the files are written to a temporary dir inside the
+       output dir (so that the same .clang-format file is found as for the
+       final files) and formatted with a few batched calls.  With stdin the
+       content is piped through one clang-format process per file instead,
+       a few at a time, and nothing is written to disk.
+
+    Args:
+        outputs (dict): file name -> generated content
+        formatter (string): one of FORMATTERS
+        report (TimingReport, optional): collects stage timings. Defaults to None.
+        stdin (bool, optional): feed clang-format through stdin. Defaults to False.
+
+    Returns:
+        dict: file name -> final content
+    """
+    if report is None:
+        report = TimingReport()
+    formatter = resolve_formatter(formatter)
+    output_dir = active_generator().output_dir
+    if formatter != 'clang-format' or not outputs:
+        return {file_name: format_output(file_name, result, formatter, None, report)
+                for file_name, result in outputs.items()}
+
+    if stdin:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            results = pool.map(format_output, outputs, outputs.values(), repeat(formatter),
+                               [os.path.join(output_dir, file_name) for file_name in outputs],
+                               repeat(report))
+            return dict(zip(outputs, results))
+
+    os.makedirs(output_dir, exist_ok=True)
+    format_dir = tempfile.mkdtemp(dir=output_dir, prefix=".format-")
+    try:
+        paths = []
+        for file_name, result in outputs.items():
+            path = os.path.join(format_dir, file_name)
+            with open(path, 'w', encoding="utf8") as out_file:
+                out_file.write(result)
+            paths.append(path)
+        with report.stage(TimingReport.RUN, 'clang_format'):
+            clang_format(paths)
+
+        formatted = {}
+        for file_name, path in zip(outputs, paths):
+            with open(path, 'r', encoding="utf8") as in_file:
+                result = in_file.read()
+            with report.stage(file_name, 'clean'):
+                formatted[file_name] = clean(result)
+        return formatted
+    finally:
+        shutil.rmtree(format_dir, ignore_errors=True)
+
+
+def source_date_epoch():
+    """SOURCE_DATE_EPOCH (see reproducible-builds.org) from the environment
 
+    Returns:
+        int: seconds since 1970, None if it is not set
 
-def clang_format(file):
-    """run clang-format for given file
+    Raises:
+        ValueError: it is set, but not to a number of seconds
+    """
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch is None:
+        return None
+    if not re.fullmatch(r"[0-9]+", epoch):
+        raise ValueError(f"SOURCE_DATE_EPOCH must be a number of seconds since 1970, not '{epoch}'")
+    return int(epoch)
 
-    Args:
-        file (filePath): file to check
+
+def generation_timestamp():
+    """timestamp written into the generated files
+       If SOURCE_DATE_EPOCH is set (see reproducible-builds.org) it is used
+       instead of the current time, so the same inputs give the same bytes.
+       In reproducible mode without it there is no timestamp at all.
+
+    Returns:
+        string: formatted time (UTC for SOURCE_DATE_EPOCH), "" for none
+
+    Raises:
+        ValueError: invalid SOURCE_DATE_EPOCH
     """
-    call(['clang-format', '-i', file])
+    epoch = source_date_epoch()
+    if epoch is not None:
+        return time.strftime(TIMESTAMP_FORMAT, time.gmtime(epoch))
+    if active_generator().reproducible:
+        return ""
+    return time.strftime(TIMESTAMP_FORMAT)
 
 
 def boilerplate_from_file():
     """read the boilerplate file content into a string
+       The file is read only once per generator, clear_template_caches()
+       forgets it.
 
     Returns:
         string: file content
     """
-    path = env.loader.get_file_location('boilerplate.txt')
-    return open(path, 'r', encoding="utf8").read()
+    generator = active_generator()
+    if generator.boilerplate is None:
+        path = generator.template_loader.get_file_location(BOILERPLATE_FILE)
+        with open(path, 'r', encoding="utf8") as in_file:
+            generator.boilerplate = in_file.read()
+    return generator.boilerplate
 
 # ---------------------------------------------------------------
 # Type definitions generation
@@ -134,436 +387,1530 @@ def boilerplate_from_file():
 # ---------------------------------------------------------------
 
 # Here we use a combination of a Set for existence, and an array for ordered
-# storage. An OrderedDict / OrderedSet could be an alternative but swapping
-# elements seemed messier there than in a plain array.
+# storage.  The array is put into dependency order by reorder_types(), using
+# the edges stored in a DependencyIndex.  Types are named by their fully
+# qualified name (package.namespace.type), so equally named types of
+# different namespaces don't get mixed up.
+#
+# All of it lives in a GenerationJob instead of module globals, so that
+# several FIDL files can be processed at the same time.
 
 
-is_rendered = set()
-rendered_types_ordered = []
-reference_pairs = set()
+class DependencyIndex:
+    """Forward and reverse adjacency of the type reference graph
+       Both directions are kept as dicts of sets, so "what does X depend
+       on" and "who depends on X" are single lookups.  Plain data only, so
+       it can be pickled back from the worker processes.  Types without
+       references share one empty frozenset instead of an empty set each.
+    """
 
+    NO_REFERENCES = frozenset()
 
-def a_reference_to_b(element_a, element_b):
-    """Does a reference b?
+    def __init__(self):
+        self.forward = {}   # referencer -> set of referenced
+        self.reverse = {}   # referenced -> set of referencers
 
-    Args:
-        a (_type_): any element
-        b (_type_): any (other) element
+    def __len__(self):
+        return len(self.forward)
 
-    Returns:
-        _type_: ??
-    """
-    return (element_a, element_b) in reference_pairs
+    def add_type(self, name):
+        """register a type, also if it doesn't reference anything
 
+        Args:
+            name (string): fully qualified name
+        """
+        self.forward.setdefault(name, self.NO_REFERENCES)
 
-def type_reference(element_a, element_b):
-    """Used as a Set - the pair exists or not
+    def add(self, referencer, referenced):
+        """Used as a Set - the edge exists or not
 
-    Args:
-        a (_type_): any element
-        b (_type_): any (other) element
-    """
-    reference_pairs.add((element_a, element_b))
+        Args:
+            referencer (string): name of the referencing type
+            referenced (string): name of the referenced type
+        """
+        references = self.forward.get(referencer)
+        if not references:
+            references = self.forward[referencer] = set()
+        references.add(referenced)
+        self.reverse.setdefault(referenced, set()).add(referencer)
 
+    def dependencies(self, name):
+        """types that name references directly
 
-def store_rendered_type(name, text):
-    """
-    Because of files including files (including files...) there can be
-    rendered duplicates and we make sure to avoid that.
+        Args:
+            name (string): fully qualified name
 
-    Args:
-        name (string): name of element
-        text (string): already rendered text
-    """
-    if name not in is_rendered:
-        is_rendered.add(name)
-        rendered_types_ordered.append((name, text))
+        Returns:
+            set: referenced names
+        """
+        return self.forward.get(name, self.NO_REFERENCES)
+
+    def dependents(self, name):
+        """types that reference name directly
 
+        Args:
+            name (string): fully qualified name
 
-def reset_rendered_types():
-    """Empty all data structures"""
-    reference_pairs.clear()
-    is_rendered.clear()
-    rendered_types_ordered[:] = []
+        Returns:
+            set: referencing names
+        """
+        return self.reverse.get(name, self.NO_REFERENCES)
 
+    def clear(self):
+        """Remove all types and edges"""
+        self.forward.clear()
+        self.reverse.clear()
 
-def process_file(file):
-    """
-    Relative path includes seem to only work if we're in the right
-    working directory also for the file:
+    def merge(self, other):
+        """add all types and edges of another index
 
-    Args:
-        file (filePath): path to FIDL file
-    """
+        Args:
+            other (DependencyIndex): index to merge
+        """
+        for referencer, referenced in other.forward.items():
+            self.add_type(referencer)
+            for name in referenced:
+                self.add(referencer, name)
 
-    dir_name = os.path.dirname(file)
-    file_name = os.path.basename(file)
-    os.chdir(dir_name)
+    def to_json(self):
+        """
+        Returns:
+            string: JSON object, type -> {"depends_on": [...], "used_by": [...]}
+        """
+        names = sorted(set(self.forward) | set(self.reverse))
+        return json.dumps({name: {'depends_on': sorted(self.dependencies(name)),
+                                  'used_by': sorted(self.dependents(name))}
+                           for name in names}, indent=2) + "\n"
 
-    file = open(file_name, "r", encoding="utf8")
-    file_content = file.read().replace('\r\n', '\n')  # Need to get rid of Windows linefeeds
-    fidl_text = file_content.replace('^version', 'interfaceversion') \
-        # FIXME, dirty fix of ^ escape character
+    def to_dot(self):
+        """
+        Returns:
+            string: graph in Graphviz DOT format, edges point to the referenced type
+        """
+        lines = ["digraph types {"]
+        for name in sorted(self.forward):
+            lines.append(f'    "{name}";')
+            for referenced in sorted(self.forward[name]):
+                lines.append(f'    "{name}" -> "{referenced}";')
+        lines.append("}")
+        return "\n".join(lines) + "\n"
 
-    # dump_contents(f, s)
-    process_fidl(file_name, fidl_text)
-    os.chdir(workingdir)
+    def write(self, path):
+        """write the index to path, as DOT if it ends with .dot, else as JSON
 
+        Args:
+            path (filePath): output file
+        """
+        with open(path, "w", encoding="utf8") as file:
+            file.write(self.to_dot() if path.endswith(".dot") else self.to_json())
 
-def process_fidl(name, fidl_text):
-    """process content of the FIDL file
+
+class GenerationJob:
+    """State for generating the outputs of a single FIDL file
 
     Args:
-        name (string): file name
-        fidl_text (string): content of FIDL file
+        fidl_file (filePath): path to the FIDL file
+        timestamp (string, optional): written into the generated files.
+            Defaults to None (generation_timestamp()).
     """
-    processor = Processor()
-    try:
-        processor.import_string(name, fidl_text)
-    except (LexerException, ParserException, ProcessorException) as exception:
-        print(f"ERROR: {exception}")
 
-    template = "interfaceheader.tpl"
-    template_render_plain_file(processor, ['interfaces'], template, "i", ".h")
+    def __init__(self, fidl_file, timestamp=None):
+        self.fidl_file = fidl_file
+        self.timestamp = generation_timestamp() if timestamp is None else timestamp
+        self.is_rendered = set()
+        self.rendered_types_ordered = []
+        self.type_index = DependencyIndex()     # of the namespace being rendered
+        self.dependency_index = DependencyIndex()   # of all namespaces of the model
+        self.outputs = []   # (file name, content) in generation order
+        self.targets = ()       # output kinds generated
+        self.target = None      # output kind being rendered
+        self.used_templates = {}    # template -> AST kinds, of the output being rendered
+        self.output_sources = {}    # file name -> target, templates and AST kinds it was rendered from
+        self.dependencies = []  # all FIDL files read, including imports
+        self.imports = {}       # FIDL file -> files it imports directly
+        self.type_definitions = {}  # fully qualified type name -> TypeDefinition
+        self.parse_time_saved = 0.0
+        self.type_spelling_stats = Counter()   # 'hits', 'misses' of render_type_name()
+        self.timings = {}       # stage -> {'seconds': float, 'calls': int}
+        self.errors = []
+
+    def stage(self, name):
+        """measure a stage of the generation of this file
+
+        Args:
+            name (string): name of the stage
+        """
+        return timed(self.timings, name)
+
+    def render(self, tpl, **context):
+        """render a template, measured as stage 'render <template>'
 
-    template = "classheader.tpl"
-    template_render_plain_file(processor, ['interfaces'], template, "", ".h")
+        Args:
+            tpl (Template): jinja template
+            context: template variables
 
-    template = "class.tpl"
-    template_render_plain_file(processor, ['interfaces'], template, "", ".cpp")
+        Returns:
+            string: rendered text
+        """
+        self.use_template(tpl, context)
+        with self.stage(f"render {tpl.name}"):
+            return tpl.render(**context)
 
-    template = "unittest.tpl"
-    template_render_plain_file(processor, ['interfaces'], template, "utest_", "_mock.h")
+    def render_fragments(self, tpl, **context):
+        """render a template into a list of fragments (see render())
 
-    render_typedef_file(processor, ['interfaces', 'typecollections'], ".types.h")
+        Args:
+            tpl (Template): jinja template
+            context: template variables
 
+        Returns:
+            list: rendered text fragments
+        """
+        self.use_template(tpl, context)
+        with self.stage(f"render {tpl.name}"):
+            return list(tpl.generate(**context))
 
-def clean(fidl_file):
-    """Some needed cleanup (smarter templates might avoid this)
+    def use_template(self, tpl, context):
+        """remember that the output being rendered uses a template, and for
+           which kind of AST element
+
+        Args:
+            tpl (Template): jinja template
+            context (dict): template variables
+        """
+        kinds = self.used_templates.setdefault(tpl.name, set())
+        if 'item' in context:
+            kinds.add(type(context['item']).__name__)
+
+    def begin_output(self):
+        """start recording the templates of the next output"""
+        self.used_templates = {}
+
+    def store_rendered_type(self, name, text):
+        """
+        Because of files including files (including files...) there can be
+        rendered duplicates and we make sure to avoid that.
+
+        Args:
+            name (string): name of element
+            text (string): already rendered text
+        """
+        if name not in self.is_rendered:
+            self.is_rendered.add(name)
+            self.rendered_types_ordered.append((name, text))
+
+    def reset_rendered_types(self):
+        """Empty all type data structures"""
+        self.type_index.clear()
+        self.is_rendered.clear()
+        self.rendered_types_ordered[:] = []
+
+    def add_output(self, result, name, prefix, suffix):
+        """queue generated content to be written by write_result_file()
+
+        Args:
+            result (string): generated file content
+            name (string): base name of the file
+            prefix (string): prefix to the filename (e.g. "I" for interface files)
+            suffix (string): postfix of the filename (e.g. the ".hpp"/".cpp")
+        """
+        file_name = prefix + name + suffix
+        self.outputs.append((file_name, result))
+        self.output_sources[file_name] = {
+            'target': self.target,
+            'templates': sorted(set(self.used_templates) | {BOILERPLATE_FILE}),
+            'kinds': {name: sorted(kinds) for name, kinds in sorted(self.used_templates.items())},
+        }
+
+
+# ----- FIDL model cache -----
+# A model imported by many FIDL files is parsed only once per run (per
+# worker process) and its AST is shared by all files importing it.
+# Optionally the parsed models are also pickled to disk, keyed by content
+# hash, so the next run can skip parsing unchanged files altogether.
+
+
+EMPTY_COMMENTS = OrderedDict()  # shared by all AST nodes without comments, see compact_model()
+
+
+def compact_model(package):
+    """let all AST nodes without comments share one empty dict
+       Most types, fields, enumerators and arguments have no comments, an
+       empty OrderedDict for each of them is a large part of a big model.
+       Only the parser fills comments, the shared dict stays empty.
 
-       TODO - maybe check that result is not empty before writing file
     Args:
-        file (filePath): path to FIDL file
+        package (ast.Package): freshly parsed package
+    """
+    seen = set()
+    pending = [package]
+    while pending:
+        node = pending.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(getattr(node, 'comments', None), OrderedDict) and not node.comments:
+            node.comments = EMPTY_COMMENTS
+        for value in vars(node).values():
+            if isinstance(value, dict):
+                value = value.values()
+            elif not isinstance(value, list):
+                value = [value]
+            pending.extend(child for child in value if type(child).__module__ == backend().ast.__name__)
+
+
+class ModelCache:
+    """Parsed FIDL models, shared between all files of a run
+
+    Args:
+        cache_dir (filePath, optional): dir for pickled models. Defaults to None.
+        low_memory (bool, optional): don't keep the models in memory (only
+            in cache_dir, if given) and compact them. Defaults to False.
     """
-    with open(fidl_file, 'r', encoding="utf8") as in_file:
-        file_content = in_file.read()
-        file_content = file_content.replace('){', ')\n{')
-        file_content = file_content.replace(',)', ')')
 
-    with open(fidl_file, 'w', encoding="utf8") as out_file:
-        out_file.write(file_content)
+    def __init__(self, cache_dir=None, low_memory=False):
+        self.cache_dir = cache_dir
+        self.low_memory = low_memory
+        self.models = {}    # path -> (digest of text, package, parse time)
+        self.imports = {}   # path -> {imported path: package its references point into}
+
+    def package(self, path, fidl_text):
+        """get the parsed package of a FIDL file
+
+        Args:
+            path (filePath): absolute path to the FIDL file
+            fidl_text (string): preprocessed content of the file
+
+        Returns:
+            tuple: (ast.Package, seconds of parse time saved by the cache)
+        """
+        digest = hashlib.sha256(fidl_text.encode("utf8")).hexdigest()
+        entry = self.models.get(path)
+        if entry is not None and entry[0] == digest and self._imports_current(path, set()):
+            return entry[1], entry[2]
+        # The references of a new model are resolved again
+        self.imports.pop(path, None)
+
+        start = time.perf_counter()
+        package = self._load(digest)
+        if package is None:
+            package = backend().Parser().parse(fidl_text)
+            parse_time = time.perf_counter() - start
+            self._store(digest, package, parse_time)
+            saved = 0.0
+        else:
+            parse_time = package.parse_time
+            saved = parse_time - (time.perf_counter() - start)
+        package.files = [path]
+        if self.low_memory:
+            compact_model(package)
+        else:
+            self.models[path] = (digest, package, parse_time)
+        return package, saved
+
+    def invalidate(self, paths):
+        """forget the parsed models of the given files
+           Models importing them must be invalidated too, as their resolved
+           references point into the old ASTs.
+
+        Args:
+            paths (iterable): absolute paths to FIDL files
+        """
+        for path in paths:
+            self.models.pop(path, None)
+            self.imports.pop(path, None)
+
+    def record_imports(self, path, imported):
+        """remember the models the resolved model of path references
+
+        Args:
+            path (filePath): absolute path to the FIDL file
+            imported (iterable): absolute paths of the FIDL files it imports
+        """
+        if path in self.models:
+            self.imports[path] = {imported_path: self.models[imported_path][1]
+                                  for imported_path in imported if imported_path in self.models}
+
+    def _imports_current(self, path, seen):
+        """check that the models a model references are still the cached
+           ones and their files unchanged, recursively
+           The resolved references of a model point into the ASTs of its
+           imports, a changed import makes them stale.
 
+        Args:
+            path (filePath): absolute path to the FIDL file
+            seen (set): paths checked already
 
-def write_result_file(result, name, prefix, suffix):
-    """write the generated content into a file
-       location of the new file is the "workingdir"
+        Returns:
+            bool: True if the model can be reused
+        """
+        for imported_path, package in self.imports.get(path, {}).items():
+            if imported_path in seen:
+                continue
+            seen.add(imported_path)
+            entry = self.models.get(imported_path)
+            if entry is None or entry[1] is not package:
+                return False
+            try:
+                text = backend().read_fidl_file(imported_path)
+            except OSError:
+                return False
+            if hashlib.sha256(text.encode("utf8")).hexdigest() != entry[0] \
+                    or not self._imports_current(imported_path, seen):
+                return False
+        return True
+
+    def _pickle_path(self, digest):
+        return os.path.join(self.cache_dir, f"{digest}-{backend().PYFRANCA_VERSION}.pickle")
+
+    def _load(self, digest):
+        """load a pickled model from the cache dir"""
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._pickle_path(digest), 'rb') as in_file:
+                return pickle.load(in_file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+
+    def _store(self, digest, package, parse_time):
+        """pickle a freshly parsed (not yet resolved) model to the cache dir"""
+        if self.cache_dir is None:
+            return
+        package.parse_time = parse_time
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(tmp_fd, 'wb') as out_file:
+            pickle.dump(package, out_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self._pickle_path(digest))
+
+
+def configure_worker(settings):
+    """set up the generator of a worker process, used as process pool initializer
 
     Args:
-        result (string): generated file content
-        name (string): base name of the file
-        prefix (string): prefix to the filename (e.g. "I" for interface files)
-        suffix (string): postfix of the filename (e.g. the ".hpp"/".cpp")
+        settings (dict): from Generator.worker_settings()
     """
-    out_file = output_dir + "/" + prefix + name + suffix
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
+    settings = dict(settings)
+    model_cache = ModelCache(settings.pop('model_cache_dir'), settings['low_memory'])
+    current_generator.set(Generator(model_cache=model_cache, **settings))
 
-    with open(out_file, 'w', encoding="utf8") as out_file_ptr:
-        out_file_ptr.write(result)
-    # clean up result
-    clang_format(out_file)
-    clean(out_file)
-    print(f"Wrote file: {out_file}")
 
-# ----- Rendering helpers -----
-# These functions take some of the logic out of the rendering templates which
-# would otherwise be a little messy.
+def process_file(file, targets=DEFAULT_TARGETS, timestamp=None):
+    """read and process a FIDL file
+       The path is made absolute, so that pyfranca resolves the relative
+       imports of the file from its own directory.
 
+    Args:
+        file (filePath): path to FIDL file
+        targets (tuple, optional): output kinds to generate. Defaults to DEFAULT_TARGETS.
+        timestamp (string, optional): written into the generated files.
+            Defaults to None (generation_timestamp()).
 
-def is_array(parameter_name):
-    """check if element is an array
-       Arrays are complex types and can't be rendered like normal ones The AST
-       requires us to extract the inner *referenced* type.name rather than usually
-       simply the name of the type.
+    Returns:
+        GenerationJob: the generated outputs
+    """
+    log("-------------------------------------------------------")
+    log(f" ----- PROCESSING {file} -----")
+    log("-------------------------------------------------------")
+
+    file = os.path.abspath(file)
+    job = GenerationJob(file, timestamp)
+    with job.stage('process_file'):
+        try:
+            fidl_text = backend().read_fidl_file(file)
+        except (OSError, UnicodeDecodeError) as exception:
+            # Like an invalid model: reported, and the other files are still generated
+            reason = exception.strerror if isinstance(exception, OSError) else f"not UTF-8 ({exception.reason})"
+            job.errors.append(f"{file}: can't read: {reason}")
+            print(f"ERROR: {job.errors[-1]}")
+            log(f"Skipped {file}: unreadable")
+            return job
+
+        # dump_contents(f, s)
+        return process_fidl(file, fidl_text, job, targets)
+
+
+def process_files(files, targets, timestamp=None):
+    """process_file() for a chunk of files, one call in a worker process
 
     Args:
-        parameter_name (_type_): any type
+        files (list): paths to FIDL files
+        targets (list): output kinds to generate, per file
+        timestamp (string, optional): see process_file(). Defaults to None.
 
     Returns:
-        bool: True - element is an Array
+        list: GenerationJob per file
     """
-    return isinstance(parameter_name, ast.Array)
+    return [process_file(file, file_targets, timestamp) for file, file_targets in zip(files, targets)]
 
 
-def is_reference(parameter_name):
-    """check if element is a Reference
-       References just refer to more detailed
-       type information but are not a type themselves
+def map_bounded(pool, function, arguments, limit):
+    """like pool.map(), but with at most limit calls in flight
+       The next call is submitted when a result is taken, so finished
+       results don't pile up while the caller is busy with earlier ones.
 
     Args:
-        parameter_name (_type_): any type
+        pool (Executor): runs the calls
+        function (callable): function to call
+        arguments (iterable): argument tuple per call
+        limit (int): calls submitted but not taken yet
 
-    Returns:
-        bool: True - element is a Reference
+    Yields:
+        the results, in the order of arguments
     """
-    return isinstance(parameter_name, ast.Reference)
+    pending = deque()
+    for args in arguments:
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+        pending.append(pool.submit(function, *args))
+    while pending:
+        yield pending.popleft().result()
 
 
-def render_type(parameter_name, base_namespace=""):
-    """function called from template to render type info
+def process_fidl(name, fidl_text, job=None, targets=DEFAULT_TARGETS):
+    """process content of the FIDL file
+       Only the selected output kinds are rendered, and only the namespaces
+       they need are traversed.
 
     Args:
-        parameter_name (_type_): parameter name of a function
-        base_namespace (str, optional): additional namespace used in template. Defaults to "".
+        name (string): file name
+        fidl_text (string): content of FIDL file
+        job (GenerationJob, optional): job to add the outputs to. Defaults to None.
+        targets (tuple, optional): output kinds to generate. Defaults to DEFAULT_TARGETS.
 
     Returns:
-        _type_: fully qualified type info
+        GenerationJob: the generated outputs
     """
-    type_is_array = False
-    if base_namespace != "":
-        base_namespace = base_namespace + "::"
-    type_to_render = parameter_name.type
+    if job is None:
+        job = GenerationJob(name)
+    generator = active_generator()
+    spelling_stats = Counter(generator.type_spelling_stats)
+    processor = backend().CachingProcessor(generator.model_cache)
+    try:
+        with job.stage('import_string'):
+            processor.import_string(name, fidl_text)
+    except backend().MODEL_ERRORS as exception:
+        job.errors.append(f"{exception_location(name, processor, exception)}: {exception}")
+    job.dependencies = sorted(os.path.abspath(fspec) for fspec in processor.files)
+    for fspec, package in processor.files.items():
+        job.imports[os.path.abspath(fspec)] = sorted({
+            os.path.abspath(imported)
+            for package_import in package.imports if package_import.package_reference
+            for imported in package_import.package_reference.files})
+    if not job.errors:
+        for path, imported in job.imports.items():
+            generator.model_cache.record_imports(path, imported)
+    job.parse_time_saved = processor.parse_time_saved
+    if processor.models_reused:
+        log(f"Model cache: {processor.models_reused} models reused, "
+            f"{processor.parse_time_saved * 1e3:.1f} ms parse time saved")
+
+    # Invalid models are not rendered at all
+    if not job.errors:
+        with job.stage('validate'):
+            # The dependency graph covers the whole model, not only what
+            # this job renders
+            job.dependency_index = model_index(processor)
+            job.errors.extend(validate_model(processor, job.dependency_index))
+    if job.errors:
+        for error in job.errors:
+            print(f"ERROR: {error}")
+        log(f"Skipped {name}: invalid model")
+        return job
+
+    job.targets = tuple(targets)
+    for target in targets:
+        job.target = target
+        kind = OUTPUT_KINDS[target]
+        if kind['template'] is None:
+            render_typedef_file(job, processor, kind['namespaces'], kind['suffix'])
+        else:
+            template_render_plain_file(job, processor, kind['namespaces'], kind['template'],
+                                       kind['prefix'], kind['suffix'])
+    job.type_spelling_stats = generator.type_spelling_stats - spelling_stats
+    if generator.low_memory:
+        # The cached spellings are keyed by AST nodes, they would keep the
+        # models of this file alive
+        generator.type_spellings.clear()
 
-    if is_array(type_to_render):
-        type_to_render = parameter_name.type.type
-        type_is_array = True
+    return job
 
-    namespace = ""
-    if is_reference(type_to_render):
-        namespace = f"{base_namespace}{type_to_render.reference.namespace.name}::"
 
-    rendered_type = f"{namespace}{type_to_render.name}"
+def clean(file_content):
+    """Some needed cleanup (smarter templates might avoid this)
 
-    if type_is_array:
-        return f"std::vector<{rendered_type}>"
+       TODO - maybe check that result is not empty before writing file
+    Args:
+        file_content (string): formatted file content
 
-    return rendered_type
+    Returns:
+        string: cleaned file content
+    """
+    file_content = file_content.replace('){', ')\n{')
+    file_content = file_content.replace(',)', ')')
+    return file_content
 
 
-def render_enumerator(enum_object):
-    """function called from template to render enum info
-       Enumerators also require a bit of logic since they can have a value
-       (equal sign) or not.
+def create_temp_file(out_file):
+    """create a new, empty temporary file next to a file
+       It gets the permissions of any new file (the kernel applies the
+       umask), unlike tempfile.mkstemp() which creates it private.
 
     Args:
-        eo (enum): name of the enum
+        out_file (filePath): file the temporary file will replace
 
     Returns:
-        string: generated info
+        tuple: (file descriptor open for writing, path)
     """
-    if enum_object.value is not None:
-        return f"{enum_object.name} = {enum_object.value.value},\n"
-
-    return f"{enum_object.name},\n"
-
-
-def template_render_complex_types(package, item, imports):
-    """function called from template to render complex types
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+    while True:
+        temp_file = os.path.join(os.path.dirname(out_file),
+                                 f".{os.path.basename(out_file)}.{os.urandom(4).hex()}.tmp")
+        try:
+            return os.open(temp_file, flags, 0o666), temp_file
+        except FileExistsError:
+            continue
+
+
+def write_result_file(result, out_file):
+    """write the final (formatted and cleaned) content into a file
+       The directory of the file must exist.
+
+       An existing file with the same content (same size and hash) is left
+       untouched, so its mtime does not trigger a rebuild.  Otherwise the
+       content goes to a temporary file that replaces the old one, so a
+       build running at the same time never sees a half-written file.
+       A replaced file keeps its permissions.
 
     Args:
-        package (string): package the item is in
-        item (string): item name
-        imports (list): list of imports of given <package>
+        result (string): final file content
+        out_file (filePath): file to write
 
     Returns:
-        string: generated info
+        bool: True if the file was (re)written
     """
-    result = ""
+    data = result.encode("utf8")
+    try:
+        existing = os.stat(out_file)
+    except FileNotFoundError:
+        existing = None
+    unchanged = existing is not None and existing.st_size == len(data) \
+        and file_digest(out_file) == hashlib.sha256(data).hexdigest()
+    if unchanged:
+        print(f"Unchanged file: {out_file}")
+        return False
+
+    fd, temp_file = create_temp_file(out_file)
+    try:
+        with os.fdopen(fd, 'wb') as out_file_ptr:
+            out_file_ptr.write(data)
+        if existing is not None:
+            os.chmod(temp_file, existing.st_mode & 0o7777)
+        os.replace(temp_file, out_file)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_file)
+        raise
+    print(f"Wrote file: {out_file}")
+    return True
 
-    timestamp = time.strftime("%Y-%m-%d, %H:%M:%d")
 
-    # Store the type reference hierarchy
-    for structure in item.structs.values():
-        for fields in structure.fields.values():
-            if is_array(fields.type):
-                # The relevant reference is to the inner type (elements of array)
-                type_reference(structure.name, fields.type.type.name)
-            else:
-                type_reference(structure.name, fields.type.name)
+# ----- Output sinks -----
+# Where the final content of the generated files goes.  A sink gets the
+# output dir of the generator with every file, so one sink can collect the
+# files of several generators (e.g. all entries of a manifest).  Only
+# DiskSink touches the file system, the others get the content directly.
 
-        tpl = env.get_template('struct.tpl')
-        rendered_text = tpl.render(item=structure, render_type=render_type)
-        store_rendered_type(structure.name, rendered_text)
 
-    for unions in item.unions.values():
-        for fields in unions.fields.values():
-            if is_array(fields.type):
-                # The relevant reference is to the inner type (elements of array)
-                type_reference(unions.name, fields.type.type.name)
-            else:
-                type_reference(unions.name, fields.type.name)
+class OutputSink:
+    """Base class of the sinks
 
-        tpl = env.get_template('union.tpl')
-        rendered_text = tpl.render(item=unions, render_type=render_type)
-        store_rendered_type(unions.name, rendered_text)
+    Args:
+        root (filePath, optional): entries are named relative to this dir.
+            Defaults to None, i.e. relative to the output dir of each file.
+    """
 
-    for enumerations in item.enumerations.values():
-        for parameter_name in enumerations.enumerators.values():
-            type_reference(enumerations.name, parameter_name.name)  # FIXME This is not needed...
-        if enumerations.extends is not None:
-            type_reference(enumerations.name, enumerations.extends)
+    def __init__(self, root=None):
+        self.root = os.path.abspath(root) if root is not None else None
 
-        tpl = env.get_template('enumeration.tpl')
-        rendered_text = tpl.render(item=enumerations, render_enumerator=render_enumerator)
-        store_rendered_type(enumerations.name, rendered_text)
+    def entry_name(self, output_dir, file_name):
+        """
+        Args:
+            output_dir (filePath): output dir of the generator
+            file_name (string): file name, including prefix and suffix
 
-    for type_defs in item.typedefs.values():
-        type_reference(type_defs.name, type_defs.type.name)
+        Returns:
+            string: name of the file in this sink
+        """
+        if self.root is None:
+            return file_name
+        return os.path.relpath(os.path.join(output_dir, file_name), self.root).replace(os.sep, "/")
 
-        tpl = env.get_template('typedef.tpl')
-        rendered_text = tpl.render(item=type_defs, render_type=render_type)
-        store_rendered_type(type_defs.name, rendered_text)
+    def prepare(self, output_dir, file_names):
+        """called once per run, before the files are written
 
-    for arrays in item.arrays.values():
-        type_reference(arrays.name, arrays.type.name)
+        Args:
+            output_dir (filePath): output dir of the generator
+            file_names (iterable): files that will be written
+        """
 
-        tpl = env.get_template('array.tpl')
-        rendered_text = tpl.render(item=arrays, render_type=render_type)
-        store_rendered_type(arrays.name, rendered_text)
+    def write(self, output_dir, file_name, content):
+        """take the final content of one file
 
-    for maps in item.maps.values():
-        type_reference(maps.name, maps.key_type.name)
-        type_reference(maps.name, maps.value_type.name)
+        Args:
+            output_dir (filePath): output dir of the generator
+            file_name (string): file name, including prefix and suffix
+            content (string): final file content
 
-        tpl = env.get_template('map.tpl')
-        rendered_text = tpl.render(item=maps)
-        store_rendered_type(maps.name, rendered_text)
+        Returns:
+            bool: True if the file was (re)written
+        """
+        raise NotImplementedError
 
-    # Determine type rendering order
-    sys.stdout.write("Reordering type definitions : ")
-    swap_occurred = True
-    while swap_occurred:
-        sys.stdout.write('.')
-        swap_occurred = reorder_types()
-    print("")
-
-    # OK, now output rendered types in the right order
-    for idx, rendered_text in enumerate(rendered_types_ordered):
-        result += f"\n// Typedef #{idx} from {item.name} in package {package.name}\n"
-        result += rendered_text[1]
+    def close(self):
+        """called when no more files follow"""
 
-    tpl = env.get_template('typesheader.tpl')
-    fullresult = tpl.render(body=result, timestamp=timestamp,
-                            boilerplate=boilerplate_from_file(),
-                            imports=list(imports),
-                            name=item.name)
 
-    return fullresult
+class DiskSink(OutputSink):
+    """Write the files into the output dir, see write_result_file()"""
 
+    def prepare(self, output_dir, file_names):
+        for directory in {os.path.dirname(os.path.join(output_dir, file_name)) for file_name in file_names}:
+            os.makedirs(directory, exist_ok=True)
 
-def swap_them(item_1, item_2):
-    """swap order of items to make sure
-       referred types are mentioned first
+    def write(self, output_dir, file_name, content):
+        return write_result_file(content, os.path.join(output_dir, file_name))
 
-    Args:
-        a (_type_): any item
-        b (_type_): any other item
-    """
 
-    # Get indices
-    item_index_1 = rendered_types_ordered.index(item_1)
-    item_index_2 = rendered_types_ordered.index(item_2)
+class MemorySink(OutputSink):
+    """Keep the files in self.files (entry name -> content)"""
 
-    rendered_types_ordered[item_index_1], rendered_types_ordered[item_index_2] = rendered_types_ordered[item_index_2], rendered_types_ordered[item_index_1]
+    def __init__(self, root=None):
+        super().__init__(root)
+        self.files = {}
 
+    def write(self, output_dir, file_name, content):
+        name = self.entry_name(output_dir, file_name)
+        written = self.files.get(name) != content
+        self.files[name] = content
+        return written
 
-def reorder_types():
-    """
-    What are we doing here?
-    => If a complex type (e.g. struct) references another type, then the
-    referenced type must be defined before it is used.   If it's defined
-    after, we swap the location of the referencer and referencee.
-    Repeat this process until no more swaps are necessary.
 
-    WARNING: This is a solution with O(n^3) complexity!  Although it's still
-    exponential it might be improved greatly by using another datastructure
-    (with O(1) lookup), so that the inner loop deals ONLY with those types
-    that are actually referenced by the first one.  But for the sizes we deal
-    with, this seems to be fine for now.
+class ArchiveSink(OutputSink):
+    """Pack the files into a tar or zip archive, as they arrive
+       The format follows the file name: .zip, .tar.gz/.tgz, .tar.xz,
+       .tar.bz2, anything else is an uncompressed tar.  Entries get the
+       SOURCE_DATE_EPOCH as mtime if it is set, so the archive is
+       reproducible, too.
 
-    (Note it will also likely deadlock if a file has a circular dependency!
-    Opportunity for improvement here...)
+    Args:
+        target (filePath): archive file, "-" for a tar stream on stdout
+        root (filePath, optional): see OutputSink. Defaults to None.
+        stream (file, optional): binary stream to write instead of target,
+            e.g. from reserved_stdout(). Defaults to None.
 
-    Returns:
-        _type_: ???
+    Raises:
+        ValueError: invalid SOURCE_DATE_EPOCH
     """
 
-    for rendered_item_1 in rendered_types_ordered:
-        # We deal with the names of the types.  FIXME: A named tuple would be nice here.
-        rendered_name_1 = rendered_item_1[0]
-        for rendered_item_2 in rendered_types_ordered:
-            rendered_name_2 = rendered_item_2[0]
-            if a_reference_to_b(rendered_name_1, rendered_name_2) and \
-                    rendered_types_ordered.index(rendered_item_1) < \
-                    rendered_types_ordered.index(rendered_item_2):
-                swap_them(rendered_item_1, rendered_item_2)
-                return True
+    TAR_MODES = (('.tar.gz', 'gz'), ('.tgz', 'gz'), ('.tar.xz', 'xz'), ('.tar.bz2', 'bz2'))
+
+    def __init__(self, target, root=None, stream=None):
+        import tarfile
+        import zipfile
+        super().__init__(root)
+        if target == "-" and stream is None:
+            stream = sys.stdout.buffer
+        epoch = source_date_epoch()
+        self.mtime = int(time.time()) if epoch is None else epoch
+        if target.endswith('.zip'):
+            self.archive = zipfile.ZipFile(stream or target, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            compression = next((mode for suffix, mode in self.TAR_MODES if target.endswith(suffix)), '')
+            # Streaming mode, stdout can't seek
+            mode = f"w|{compression}" if stream is not None else f"w:{compression}"
+            self.archive = tarfile.open(None if stream is not None else target, mode, fileobj=stream,
+                                        format=tarfile.PAX_FORMAT)
+
+    def write(self, output_dir, file_name, content):
+        import tarfile
+        import zipfile
+        name = self.entry_name(output_dir, file_name)
+        data = content.encode("utf8")
+        if isinstance(self.archive, zipfile.ZipFile):
+            # zip can't store dates before 1980
+            date_time = time.gmtime(max(self.mtime, 315532800))[:6]
+            info = zipfile.ZipInfo(name, date_time)
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = self.mtime
+            info.mode = 0o644
+            self.archive.addfile(info, io.BytesIO(data))
+        return True
 
-    # FIXME = notice and break circular dependency
-    return False
+    def close(self):
+        self.archive.close()
 
 
-def template_render_plain_file(processor, filterstr, template_file, prefix, suffix):
-    """This is used for rendering source files that are not just a list of types.
-       For example as class declarations (.h) and class method body defintion
-       (.cpp)
+class ManifestSink(OutputSink):
+    """Print one JSON object per file: name, size, sha256 and (optionally)
+       the content, e.g. for a packaging step reading stdout
 
     Args:
-        processor (_type_): jinja processor (AST)
-        filterstr (string): filter for type of file to be created
-        template_file (filePath): template file to use for generation
-        prefix (string): prefix for output filename
-        suffix (string): postfix for output filename
+        stream (file, optional): binary stream. Defaults to stdout.
+        root (filePath, optional): see OutputSink. Defaults to None.
+        with_content (bool, optional): include the content. Defaults to True.
     """
-    tpl = env.get_template(template_file)
-    timestamp = time.strftime("%Y-%m-%d, %H:%M:%d")
 
-    result = ""
-    for packages in processor.packages.values():
-        # TODO Redo the imports --> #include connection
-        imports = map(lambda parameter_name: parameter_name.namespace_reference, packages.imports)
+    def __init__(self, stream=None, root=None, with_content=True):
+        super().__init__(root)
+        self.stream = stream if stream is not None else sys.stdout.buffer
+        self.with_content = with_content
+
+    def write(self, output_dir, file_name, content):
+        data = content.encode("utf8")
+        entry = {'name': self.entry_name(output_dir, file_name),
+                 'size': len(data),
+                 'sha256': hashlib.sha256(data).hexdigest()}
+        if self.with_content:
+            entry['content'] = content
+        self.stream.write(json.dumps(entry).encode("utf8") + b"\n")
+        return True
+
+    def close(self):
+        self.stream.flush()
+
+
+@contextlib.contextmanager
+def reserved_stdout():
+    """keep stdout for a sink, everything else that is printed (log output
+       of this and of worker processes, clang-format) goes to stderr
+
+    Yields:
+        file: binary stream of the original stdout
+    """
+    sys.stdout.flush()
+    original = os.dup(1)
+    stream = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    try:
+        yield stream
+    finally:
+        stream.close()
+        sys.stdout.flush()
+        os.dup2(original, 1)
+        os.close(original)
+
+
+# ----- Rendering helpers -----
+# These functions take some of the logic out of the rendering templates which
+# would otherwise be a little messy.
+
+
+def is_array(parameter_name):
+    """check if element is an array
+       Arrays are complex types and can't be rendered like normal ones The AST
+       requires us to extract the inner *referenced* type.name rather than usually
+       simply the name of the type.
+
+    Args:
+        parameter_name (_type_): any type
+
+    Returns:
+        bool: True - element is an Array
+    """
+    return isinstance(parameter_name, backend().ast.Array)
+
+
+def is_reference(parameter_name):
+    """check if element is a Reference
+       References just refer to more detailed
+       type information but are not a type themselves
+
+    Args:
+        parameter_name (_type_): any type
+
+    Returns:
+        bool: True - element is a Reference
+    """
+    return isinstance(parameter_name, backend().ast.Reference)
+
+
+def render_type(parameter_name, base_namespace=""):
+    """function called from template to render type info
+
+    Args:
+        parameter_name (_type_): parameter name of a function
+        base_namespace (str, optional): additional namespace used in template. Defaults to "".
+
+    Returns:
+        _type_: fully qualified type info
+    """
+    return render_type_name(parameter_name.type, base_namespace)
+
+
+# Every use of a type in the AST is a node of its own, but references
+# resolve to the shared definition.  The C++ spelling is therefore cached
+# per definition (or built-in type name) and base namespace, so rendering
+# cost scales with the distinct types instead of with their uses.  The
+# cache belongs to the generator and lives for one run.
+
+
+def type_key(type_to_render):
+    """key for the spelling cache: the same key means the same spelling
+
+    Args:
+        type_to_render (_type_): any type
+
+    Returns:
+        _type_: definition of a referenced type, name of a built-in type,
+            tuple for implicit arrays
+    """
+    if is_array(type_to_render) and type_to_render.name is None:
+        return ('[]', type_key(type_to_render.type))
+    if is_reference(type_to_render) and type_to_render.reference is not None:
+        return type_to_render.reference
+    return type_to_render.name
+
+
+def spell_type(type_to_render, base_namespace):
+    """C++ spelling of a type, see render_type_name()
+
+    Args:
+        type_to_render (_type_): any type
+        base_namespace (string): additional namespace, "" for none
+
+    Returns:
+        string: fully qualified type info
+    """
+    if is_array(type_to_render) and type_to_render.name is None:
+        # Implicit arrays, possibly nested (e.g. UInt8[][])
+        return f"std::vector<{render_type_name(type_to_render.type, base_namespace)}>"
+
+    definition = type_to_render.reference if is_reference(type_to_render) else None
+    if definition is None or getattr(definition, 'namespace', None) is None:
+        # Built-in type (or unresolved reference)
+        return type_to_render.name
+    # Typedefs, arrays and maps are named by their own typedef, no need to
+    # follow the chain
+    if base_namespace != "":
+        base_namespace = base_namespace + "::"
+    return f"{base_namespace}{definition.namespace.name}::{definition.name}"
+
+
+def render_type_name(type_to_render, base_namespace=""):
+    """function called from template to render a type (e.g. map key or value)
+
+    Args:
+        type_to_render (_type_): any type
+        base_namespace (str, optional): additional namespace used in template. Defaults to "".
+
+    Returns:
+        string: fully qualified type info
+    """
+    generator = active_generator()
+    key = (type_key(type_to_render), base_namespace)
+    spelling = generator.type_spellings.get(key)
+    if spelling is None:
+        generator.type_spelling_stats['misses'] += 1
+        spelling = generator.type_spellings[key] = spell_type(type_to_render, base_namespace)
+    else:
+        generator.type_spelling_stats['hits'] += 1
+    return spelling
+
+
+def render_enumerator(enum_object):
+    """function called from template to render enum info
+       Enumerators also require a bit of logic since they can have a value
+       (equal sign) or not.
+
+    Args:
+        eo (enum): name of the enum
+
+    Returns:
+        string: generated info
+    """
+    if enum_object.value is not None:
+        return f"{enum_object.name} = {enum_object.value.value},\n"
+
+    return f"{enum_object.name},\n"
+
+
+def referenced_namespace(type_to_check):
+    """find the namespace a referenced type is defined in
+
+    Args:
+        type_to_check (_type_): type of a field, typedef, array, ...
+
+    Returns:
+        ast.Namespace: namespace of the referenced type, None for built-in types
+    """
+    while is_array(type_to_check) and type_to_check.name is None:
+        type_to_check = type_to_check.type
+    if is_reference(type_to_check):
+        type_to_check = type_to_check.reference
+    return getattr(type_to_check, 'namespace', None)
+
+
+def type_uses(namespace):
+    """the types used by the type definitions of a namespace
+
+    Args:
+        namespace (ast.Namespace): interface or type collection
+
+    Yields:
+        tuple: (type definition, used type) for every field, typedef,
+            array element, map key / value and extended enumeration
+    """
+    for container in chain(namespace.structs.values(), namespace.unions.values()):
+        for fields in container.fields.values():
+            yield container, fields.type
+    for enumerations in namespace.enumerations.values():
+        # the processor resolves 'extends' to the enumeration itself
+        if enumerations.reference is not None:
+            yield enumerations, enumerations.reference
+    for type_defs in namespace.typedefs.values():
+        yield type_defs, type_defs.type
+    for arrays in namespace.arrays.values():
+        yield arrays, arrays.type
+    for maps in namespace.maps.values():
+        yield maps, maps.key_type
+        yield maps, maps.value_type
+
+
+def index_types(index, namespace):
+    """add the types of a namespace and their references to an index
+
+    Args:
+        index (DependencyIndex): index to add to
+        namespace (ast.Namespace): interface or type collection
+    """
+    for kind in TYPE_KINDS:
+        for definition in getattr(namespace, kind).values():
+            index.add_type(qualified_name(definition))
+    for definition, used_type in type_uses(namespace):
+        index.add(qualified_name(definition), referenced_name(used_type))
+
+
+def qualified_name(definition):
+    """fully qualified name of a type defined in a namespace
+
+    Args:
+        definition (_type_): struct, union, enumeration, typedef, array or map
+
+    Returns:
+        string: package.namespace.type, just the name if there is no namespace
+    """
+    namespace = getattr(definition, 'namespace', None)
+    if namespace is None:
+        return definition.name
+    # Interned, the same name is a key in several indexes
+    return sys.intern(f"{namespace.package.name}.{namespace.name}.{definition.name}")
+
+
+def referenced_name(type_to_check):
+    """name of the type that is referenced by a field, typedef, array, ...
+       For implicit arrays the relevant reference is to the inner type
+       (elements of array).
+
+    Args:
+        type_to_check (_type_): any type
+
+    Returns:
+        string: fully qualified name, or the plain name of built-in and
+            unresolved types
+    """
+    while is_array(type_to_check) and type_to_check.name is None:
+        type_to_check = type_to_check.type
+    if is_reference(type_to_check):
+        if type_to_check.reference is None:
+            return type_to_check.name
+        type_to_check = type_to_check.reference
+    return qualified_name(type_to_check)
+
+
+def template_render_complex_types(job, package, item, imports):
+    """function called from template to render complex types
+       Only the types defined in item are rendered.  Headers of other
+       namespaces whose types are referenced are included instead.
+
+    Args:
+        job (GenerationJob): state of the current file
+        package (string): package the item is in
+        item (string): item name
+        imports (list): list of imported namespaces of given <package>
+
+    Returns:
+        string: generated info
+    """
+    # Look the templates up once, not for every type
+    env = active_generator().env
+    struct_tpl = env.get_template('struct.tpl')
+    union_tpl = env.get_template('union.tpl')
+    enumeration_tpl = env.get_template('enumeration.tpl')
+    typedef_tpl = env.get_template('typedef.tpl')
+    array_tpl = env.get_template('array.tpl')
+    map_tpl = env.get_template('map.tpl')
+
+    # Types of other namespaces are not rendered here, but their header
+    # must be included
+    includes = {namespace.name: namespace for namespace in imports}
+    for _, used_type in type_uses(item):
+        owner = referenced_namespace(used_type)
+        if owner is not None and owner is not item:
+            includes.setdefault(owner.name, owner)
+
+    # Store the type reference hierarchy
+    index_types(job.type_index, item)
+
+    for structure in item.structs.values():
+        rendered_text = job.render(struct_tpl, item=structure, render_type=render_type)
+        job.store_rendered_type(qualified_name(structure), rendered_text)
+
+    for unions in item.unions.values():
+        rendered_text = job.render(union_tpl, item=unions, render_type=render_type)
+        job.store_rendered_type(qualified_name(unions), rendered_text)
+
+    for enumerations in item.enumerations.values():
+        rendered_text = job.render(enumeration_tpl, item=enumerations, render_enumerator=render_enumerator)
+        job.store_rendered_type(qualified_name(enumerations), rendered_text)
+
+    for type_defs in item.typedefs.values():
+        rendered_text = job.render(typedef_tpl, item=type_defs, render_type=render_type)
+        job.store_rendered_type(qualified_name(type_defs), rendered_text)
+
+    for arrays in item.arrays.values():
+        rendered_text = job.render(array_tpl, item=arrays, render_type=render_type)
+        job.store_rendered_type(qualified_name(arrays), rendered_text)
+
+    for maps in item.maps.values():
+        rendered_text = job.render(map_tpl, item=maps, render_type_name=render_type_name)
+        job.store_rendered_type(qualified_name(maps), rendered_text)
+
+    # Determine type rendering order
+    with job.stage('reorder_types'):
+        job.rendered_types_ordered[:] = reorder_types(job.rendered_types_ordered,
+                                                      job.type_index)
+
+    # OK, now output rendered types in the right order.  The fragments are
+    # collected and joined once, repeated += would copy the growing body
+    # over and over.
+    body = []
+    source = ", ".join(package.files)
+    for idx, rendered_text in enumerate(job.rendered_types_ordered):
+        body.append(f"\n// Typedef #{idx} from {item.name} in package {package.name}\n")
+        body.append(rendered_text[1])
+        job.type_definitions[rendered_text[0]] = \
+            TypeDefinition(item.name, hashlib.sha256(rendered_text[1].encode("utf8")).digest(), source)
+
+    # The header is rendered around a placeholder, so the body is copied
+    # only once, into the final text
+    tpl = env.get_template('typesheader.tpl')
+    fragments = job.render_fragments(tpl, body=TYPES_BODY_PLACEHOLDER, timestamp=job.timestamp,
+                                     boilerplate=boilerplate_from_file(),
+                                     imports=list(includes.values()),
+                                     name=item.name)
+    head, tail = "".join(fragments).split(TYPES_BODY_PLACEHOLDER, 1)
+    return "".join(chain([head], body, [tail]))
+
+
+class TypeDefinition:
+    """What the registry needs to know about a rendered type, kept for
+       every type of a run, hence __slots__
+
+    Args:
+        owner (string): name of the namespace
+        digest (bytes): sha256 of the rendered text
+        source (string): FIDL file(s) of the package
+    """
+
+    __slots__ = ('owner', 'digest', 'source')
+
+    def __init__(self, owner, digest, source):
+        self.owner = owner
+        self.digest = digest
+        self.source = source
+
+    def same_as(self, other):
+        """
+        Returns:
+            bool: True if both definitions render the same text in the same namespace
+        """
+        return self.owner == other.owner and self.digest == other.digest
+
+
+class CircularReferenceError(Exception):
+    """Types reference each other in a cycle, so there is no order in which
+       they can be defined for the C/C++ compiler.
+
+    Args:
+        cycles (list): lists of type names, one per strongly connected component
+    """
+
+    def __init__(self, cycles):
+        self.cycles = cycles
+        message = "; ".join(" <-> ".join(members) for members in cycles)
+        super().__init__(f"Circular type reference: {message}")
+
+
+def strongly_connected_components(graph):
+    """find the strongly connected components of a graph (Tarjan)
+       Iterative, so deep reference chains don't hit the recursion limit.
+
+    Args:
+        graph (dict): node -> list of nodes it references
+
+    Returns:
+        list: one list of nodes per component, in discovery order
+    """
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph[root]))]
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(graph[successor])))
+                    break
+                if successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def reorder_types(rendered_types, index):
+    """
+    What are we doing here?
+    => If a complex type (e.g. struct) references another type, then the
+    referenced type must be defined before it is used.
+
+    The rendered types are sorted topologically (Kahn's algorithm) using the
+    forward edges of the dependency index.  Ties are broken by the original
+    rendering position, so types that don't depend on each other keep the
+    order in which they were generated.  Cost is O(n log n + e) instead of
+    the previous repeated swapping.
+
+    References to types that are not rendered here (built-in types, types
+    from other files) and self references are ignored.
+
+    Args:
+        rendered_types (list): (name, rendered text) tuples
+        index (DependencyIndex): references between the types
+
+    Returns:
+        list: rendered_types in dependency order
+
+    Raises:
+        CircularReferenceError: some types reference each other in a cycle
+    """
+    position = {name: idx for idx, (name, _) in enumerate(rendered_types)}
+    dependents = {name: [] for name in position}
+    missing = dict.fromkeys(position, 0)
+
+    for referencer in position:
+        for referenced in index.dependencies(referencer):
+            if referenced != referencer and referenced in position:
+                dependents[referenced].append(referencer)
+                missing[referencer] += 1
+
+    ready = [position[name] for name, count in missing.items() if count == 0]
+    heapq.heapify(ready)
+    ordered = []
+    while ready:
+        rendered_item = rendered_types[heapq.heappop(ready)]
+        ordered.append(rendered_item)
+        for dependent in dependents[rendered_item[0]]:
+            missing[dependent] -= 1
+            if missing[dependent] == 0:
+                heapq.heappush(ready, position[dependent])
+
+    if len(ordered) < len(rendered_types):
+        # Whatever is left depends on, or is part of, a cycle
+        left = sorted((name for name, count in missing.items() if count > 0),
+                      key=position.get)
+        graph = {name: [] for name in left}
+        for name in left:
+            for dependent in dependents[name]:
+                if dependent in graph:
+                    graph[dependent].append(name)
+        cycles = sorted((sorted(component, key=position.get)
+                         for component in strongly_connected_components(graph)
+                         if len(component) > 1), key=lambda cycle: position[cycle[0]])
+        raise CircularReferenceError(cycles)
+
+    return ordered
+
+
+# ----- Validation -----
+# A cheap check of the whole model (the file and everything it imports)
+# before anything is rendered.  Broken models are rejected, so they never
+# reach the render and format stages.  The generated types of all
+# namespaces end up in the same C++ scope, so equally named types of
+# different namespaces are an error as well.
+
+
+DEFINITION_PATTERN = r"\b(?:struct|union|enumeration|typedef|array|map|method|attribute|broadcast)\s+{}\b"
+
+
+def find_line(paths, pattern, after=None):
+    """find the first line matching a regular expression in some files
+
+    Args:
+        paths (list): files to search
+        pattern (string): regular expression
+        after (string, optional): only search behind the first match of this
+            regular expression. Defaults to None.
+
+    Returns:
+        string: "file:line", or the first file if there is no match
+    """
+    for path in paths:
+        try:
+            with open(path, 'r', encoding="utf8") as in_file:
+                fidl_text = in_file.read()
+        except (OSError, UnicodeDecodeError):
+            continue
+        start = 0
+        if after is not None:
+            start_match = re.search(after, fidl_text, re.MULTILINE)
+            if start_match is None:
+                continue
+            start = start_match.end()
+        match = re.compile(pattern, re.MULTILINE).search(fidl_text, start)
+        if match:
+            return f"{path}:{fidl_text.count(chr(10), 0, match.start()) + 1}"
+    return paths[0] if paths else "?"
+
+
+def source_location(definition):
+    """where a type, method, ... is defined, for error messages
+       The AST has no line numbers, so the definition is searched for.
+
+    Args:
+        definition (_type_): member of a namespace
+
+    Returns:
+        string: "file:line"
+    """
+    namespace = definition.namespace
+    files = list(namespace.package.files) if namespace is not None and namespace.package else []
+    after = None
+    if namespace is not None:
+        after = rf"\b(?:typeCollection|interface)\s+{re.escape(namespace.name)}\b"
+    return find_line(files, DEFINITION_PATTERN.format(re.escape(definition.name)), after)
+
+
+def exception_location(fidl_file, processor, exception):
+    """where a lexer / parser / processor error comes from, as far as known
+
+    Args:
+        fidl_file (filePath): file being processed
+        processor (CachingProcessor): processor that raised
+        exception (Exception): the error
+
+    Returns:
+        string: "file:line", or just the file
+    """
+    quoted = re.search(r"'([^']+)'", str(exception))
+    if quoted is None:
+        return fidl_file
+    files = [fidl_file] + [os.path.abspath(path) for path in processor.files
+                           if os.path.abspath(path) != fidl_file]
+    return find_line(files, rf"(?<![\w.]){re.escape(quoted.group(1))}(?![\w])")
+
+
+def member_uses(namespace):
+    """the types used by methods, broadcasts and attributes of an interface
+
+    Args:
+        namespace (ast.Namespace): interface or type collection
+
+    Yields:
+        tuple: (member, used type)
+    """
+    for attributes in getattr(namespace, 'attributes', {}).values():
+        yield attributes, attributes.type
+    for methods in getattr(namespace, 'methods', {}).values():
+        for arguments in chain(methods.in_args.values(), methods.out_args.values()):
+            yield methods, arguments.type
+    for broadcasts in getattr(namespace, 'broadcasts', {}).values():
+        for arguments in broadcasts.out_args.values():
+            yield broadcasts, arguments.type
+
+
+def model_namespaces(processor):
+    """
+    Args:
+        processor (CachingProcessor): processor holding the model
+
+    Returns:
+        list: type collections and interfaces of all packages, imports included
+    """
+    return [namespace for package in processor.packages.values()
+            for namespace in chain(package.typecollections.values(), package.interfaces.values())]
+
+
+def model_index(processor):
+    """index the types of a whole processed model, whatever is rendered of it
+
+    Args:
+        processor (CachingProcessor): processor holding the model
+
+    Returns:
+        DependencyIndex: the types of all namespaces and their references
+    """
+    index = DependencyIndex()
+    for namespace in model_namespaces(processor):
+        index_types(index, namespace)
+    return index
+
+
+def validate_model(processor, index=None):
+    """check a processed model before rendering it
+
+    Args:
+        processor (CachingProcessor): processor holding the model
+        index (DependencyIndex, optional): model_index() of it. Defaults to None (built here).
+
+    Returns:
+        list: error messages with file and line, empty if the model is fine
+    """
+    namespaces = model_namespaces(processor)
+    errors = []
+
+    # Unresolved references
+    for namespace in namespaces:
+        for member, used_type in chain(type_uses(namespace), member_uses(namespace)):
+            while is_array(used_type) and used_type.name is None:
+                used_type = used_type.type
+            if is_reference(used_type) and used_type.reference is None:
+                errors.append(f"{source_location(member)}: unresolved reference '{used_type.name}' "
+                              f"in {namespace.name}.{member.name}")
+        for enumerations in namespace.enumerations.values():
+            if enumerations.extends is not None and enumerations.reference is None:
+                errors.append(f"{source_location(enumerations)}: unresolved enumeration "
+                              f"'{enumerations.extends}' extended by {namespace.name}.{enumerations.name}")
+
+    # Duplicate type names across namespaces
+    defined = {}
+    for namespace in namespaces:
+        for kind in TYPE_KINDS:
+            for definition in getattr(namespace, kind).values():
+                known = defined.setdefault(definition.name, definition)
+                if known is not definition:
+                    errors.append(f"{source_location(definition)}: type '{definition.name}' of "
+                                  f"{namespace.name} is also defined in {known.namespace.name} "
+                                  f"({source_location(known)})")
+
+    # Circular type dependencies, as reorder_types() would find them
+    if index is None:
+        index = model_index(processor)
+    graph = {name: [referenced for referenced in sorted(referenced_names)
+                    if referenced != name and referenced in index.forward]
+             for name, referenced_names in sorted(index.forward.items())}
+    definitions = {qualified_name(definition): definition for definition in defined.values()}
+    for component in strongly_connected_components(graph):
+        if len(component) > 1:
+            members = sorted(component)
+            location = source_location(definitions[members[0]]) if members[0] in definitions else "?"
+            errors.append(f"{location}: circular type reference: {' <-> '.join(members)}")
+    return errors
+
+
+def template_render_plain_file(job, processor, filterstr, template_file, prefix, suffix):
+    """This is used for rendering source files that are not just a list of types.
+       For example as class declarations (.h) and class method body defintion
+       (.cpp)
+
+    Args:
+        job (GenerationJob): state of the current file
+        processor (_type_): jinja processor (AST)
+        filterstr (string): filter for type of file to be created
+        template_file (filePath): template file to use for generation
+        prefix (string): prefix for output filename
+        suffix (string): postfix for output filename
+    """
+    tpl = active_generator().env.get_template(template_file)
+
+    # Rendered fragments are collected in a list and joined once when the
+    # file is written, instead of copying a growing string for every item.
+    job.begin_output()
+    fragments = [boilerplate_from_file()]
+    for packages in processor.packages.values():
+        # TODO Redo the imports --> #include connection
+        imports = map(lambda parameter_name: parameter_name.namespace_reference, packages.imports)
 
         name = None
         if 'typecollections' in filterstr:
             for type_collection in packages.typecollections.values():
                 name = type_collection.name
-                rendered_text = tpl.render(item=type_collection,
-                                           name=name,
-                                           timestamp=timestamp,
-                                           render_type=render_type,
-                                           boilerplate="",
-                                           imports=list(imports))
-                result += rendered_text
+                fragments.extend(job.render_fragments(tpl, item=type_collection,
+                                                      name=name,
+                                                      timestamp=job.timestamp,
+                                                      render_type=render_type,
+                                                      boilerplate="",
+                                                      imports=list(imports)))
 
         if 'interfaces' in filterstr:
             for interfaces in packages.interfaces.values():
                 name = interfaces.name    # This takes priority for the chosen file name
-                rendered_text = tpl.render(item=interfaces,
-                                           name=name,
-                                           timestamp=timestamp,
-                                           render_type=render_type,
-                                           boilerplate="",
-                                           imports=list(imports))
-                result += rendered_text
+                fragments.extend(job.render_fragments(tpl, item=interfaces,
+                                                      name=name,
+                                                      timestamp=job.timestamp,
+                                                      render_type=render_type,
+                                                      boilerplate="",
+                                                      imports=list(imports)))
 
-        if name is not None and len(result) != 0:
-            write_result_file(boilerplate_from_file() + result, name, prefix, suffix)
+        if name is not None and any(fragments[1:]):
+            job.add_output("".join(fragments), name, prefix, suffix)
 
 
-def render_typedef_file(processor, filterstr, suffix):
+def render_typedef_file(job, processor, filterstr, suffix):
     """This is used for headers that are expected to contain types.
        the order that types are defined is critical.
 
     Args:
+        job (GenerationJob): state of the current file
         processor (_type_): jinja processor (AST)
         filterstr (string): filter for type of file to be created
         suffix (string): postfix for output filename
     """
 
-    result = ""
     for packages in processor.packages.values():
-        # TODO imports
-        imports = map(lambda parameter_name: parameter_name.namespace_reference, packages.imports)
+        # Only namespace imports can be included, "import model" has no namespace
+        imports = [package_import.namespace_reference for package_import in packages.imports
+                   if package_import.namespace_reference is not None]
 
         # FIXME does not fully take into account what parts are imported
         # self.namespace    --  None for "import model"
@@ -575,32 +1922,1413 @@ def render_typedef_file(processor, filterstr, suffix):
         # single directory and all are included without subdirectory
         # #include "namespacename.h"
 
-        reset_rendered_types()
+        namespaces = []
         if 'interfaces' in filterstr:
-            for interfaces in packages.interfaces.values():
-                result = template_render_complex_types(packages, interfaces, imports)
-                if len(result) != 0:
-                    write_result_file(result, interfaces.name, "", suffix)
-
-        reset_rendered_types()
+            namespaces.extend(packages.interfaces.values())
         if 'typecollections' in filterstr:
-            for type_collections in packages.typecollections.values():
-                result = template_render_complex_types(packages, type_collections, imports)
-                if len(result) != 0:
-                    write_result_file(result, type_collections.name, "", suffix)
+            namespaces.extend(packages.typecollections.values())
+
+        for namespace in namespaces:
+            # Every namespace gets its own header, rendered once per run even
+            # if many files import it
+            if not claim_types_header(namespace.name + suffix, packages.files):
+                continue
+            job.reset_rendered_types()
+            job.begin_output()
+            try:
+                result = template_render_complex_types(job, packages, namespace, imports)
+            except CircularReferenceError as exception:
+                print(f"ERROR: {namespace.name}: {exception}")
+                continue
+            if len(result) != 0:
+                job.add_output(result, namespace.name, "", suffix)
+    # Rendered texts and index of the last namespace are not needed anymore
+    job.reset_rendered_types()
+
+
+# ----- Type registry -----
+# Every type is rendered once per run, into the header of the namespace
+# that owns it.  The headers rendered by this process are remembered in
+# the generator's rendered_headers; the parent merges the types of all
+# jobs into a TypeRegistry to find conflicting definitions of the same type.
+
+
+def claim_types_header(header, source_files):
+    """check if a types header still needs to be rendered in this run
+
+    Args:
+        header (string): file name of the header
+        source_files (list): FIDL files of the owning package
+
+    Returns:
+        bool: True if it was not rendered yet from the same source files
+    """
+    source_files = tuple(source_files)
+    rendered_headers = active_generator().rendered_headers
+    if rendered_headers.get(header) == source_files:
+        return False
+    rendered_headers[header] = source_files
+    return True
+
+
+class TypeRegistry:
+    """Run-wide registry of rendered types, keyed by fully qualified name"""
+
+    def __init__(self):
+        self.types = {}     # fully qualified name -> TypeDefinition
+        self.conflicts = []     # (fully qualified name, first source, other source)
+
+    def add_job(self, job):
+        """register the types rendered by a job
+
+        Args:
+            job (GenerationJob): the finished job
+        """
+        for name, definition in job.type_definitions.items():
+            known = self.types.setdefault(name, definition)
+            if not known.same_as(definition):
+                conflict = (name, known.source, definition.source)
+                if conflict not in self.conflicts:
+                    self.conflicts.append(conflict)
+
+    def report(self):
+        """print the conflicting definitions"""
+        for name, first, other in self.conflicts:
+            print(f"WARNING: conflicting definitions of {name} in {first} and {other}")
+
+
+# ----- Instrumentation -----
+
+
+class TimingReport:
+    """Per file, per stage timings of a run
+
+       Stages of a FIDL file are measured by its GenerationJob (also in the
+       worker processes) and merged in here.  Formatting and writing is
+       measured per output file, batched clang-format calls under RUN.
+       Stages are inclusive, e.g. process_file contains all other stages of
+       the same FIDL file.
+    """
+
+    RUN = "(run)"
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.files = {}     # FIDL file -> stage timings
+        self.outputs = {}   # output file -> stage timings
+
+    def stage(self, output_name, stage):
+        """measure a stage working on an output file
+
+        Args:
+            output_name (string): output file name, or RUN
+            stage (string): name of the stage
+        """
+        return timed(self.outputs.setdefault(output_name, {}), stage)
+
+    def add_job(self, job):
+        """add the stage timings of a finished job
+
+        Args:
+            job (GenerationJob): the finished job
+        """
+        self.files[job.fidl_file] = job.timings
+
+    def as_dict(self):
+        """the report as JSON compatible dict, with totals per stage
+
+        Returns:
+            dict: report
+        """
+        totals = {}
+        for timings in chain(self.files.values(), self.outputs.values()):
+            for stage, entry in timings.items():
+                total = totals.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+                total['seconds'] += entry['seconds']
+                total['calls'] += entry['calls']
+        return {
+            'generator_version': GENERATOR_VERSION,
+            'wall_time': time.perf_counter() - self.start,
+            'totals': totals,
+            'files': self.files,
+            'outputs': self.outputs,
+        }
+
+    def write(self, path):
+        """write the report as JSON
+
+        Args:
+            path (filePath): report file
+        """
+        with open(path, 'w', encoding="utf8") as out_file:
+            json.dump(self.as_dict(), out_file, indent=1, sort_keys=True)
+
+
+@contextlib.contextmanager
+def profiled(kind, path):
+    """profile the block and write the result to a file
+
+    Args:
+        kind (string): 'cpu' for cProfile stats, 'memory' for tracemalloc
+            statistics, None for no profiling
+        path (filePath): output file; cProfile writes pstats data
+    """
+    if kind == 'cpu':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+            log(f"CPU profile written to {path}")
+    elif kind == 'memory':
+        import tracemalloc
+        tracemalloc.start(PROFILE_MEMORY_FRAMES)
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(path, 'w', encoding="utf8") as out_file:
+                out_file.write(f"current: {current} bytes, peak: {peak} bytes\n\n")
+                for statistic in snapshot.statistics('traceback')[:PROFILE_MEMORY_TOP]:
+                    out_file.write(f"{statistic}\n")
+                    for line in statistic.traceback.format():
+                        out_file.write(f"{line}\n")
+            log(f"Memory profile written to {path}")
+    else:
+        yield
+
+
+# ----- Build cache -----
+# Remembers, per FIDL file, the hashes of everything its outputs were
+# generated from: the FIDL file and its imports, and per output file the
+# templates it was rendered with (including imported macros and the
+# boilerplate) and the dir they came from.  Output kinds whose outputs and
+# templates are unchanged are skipped, if nothing changed the file is
+# skipped entirely.
+
+
+def file_digest(path):
+    """hash the content of a file
+
+    Args:
+        path (filePath): file to hash
+
+    Returns:
+        string: sha256 hex digest, None if the file does not exist
+    """
+    try:
+        with open(path, 'rb') as in_file:
+            return hashlib.sha256(in_file.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+class BuildCache:
+    """Persistent content-hash cache of generated FIDL files
+
+    Args:
+        path (filePath): JSON file the cache is kept in
+        templates (dict): state of the current templates, see
+            Generator.template_states()
+        targets (tuple, optional): output kinds generated. Defaults to DEFAULT_TARGETS.
+    """
+
+    def __init__(self, path, templates, targets=DEFAULT_TARGETS):
+        self.path = path
+        self.templates = templates
+        self.targets = list(targets)
+        self.hits = 0
+        self.misses = 0
+        self.entries = {}
+        try:
+            with open(path, 'r', encoding="utf8") as in_file:
+                self.entries = json.load(in_file)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def template_closure(self, names):
+        """the templates and all templates they import, recursively
+
+        Args:
+            names (iterable): template names
+
+        Returns:
+            set: template names
+        """
+        closure = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in closure:
+                closure.add(name)
+                pending.extend(self.templates.get(name, {}).get('imports', ()))
+        return closure
+
+    def template_change(self, used):
+        """
+        Args:
+            used (dict): template name -> [dir, digest] when the output was generated
+
+        Returns:
+            string: what changed, None if all templates are the same
+        """
+        for name, (origin, digest) in sorted(used.items()):
+            current = self.templates.get(name)
+            if current is None:
+                return f"template {name} was removed"
+            if current['dir'] != origin:
+                return f"template {name} now comes from the {current['dir']} dir"
+            if current['digest'] != digest:
+                return f"template {name} changed"
+        return None
+
+    def stale_targets(self, fidl_file):
+        """find the output kinds of a FIDL file that must be generated again
+
+        Args:
+            fidl_file (filePath): absolute path to the FIDL file
+
+        Returns:
+            dict: output kind -> reason, in the order of the targets; empty
+                if all outputs can be reused
+        """
+        entry = self.entries.get(fidl_file)
+        reason = None
+        if entry is None:
+            reason = "not generated before"
+        elif entry.get('version') != GENERATOR_VERSION or entry.get('format') != BUILD_CACHE_FORMAT:
+            reason = "generator version changed"
+        else:
+            changed = [path for path, digest in entry['inputs'].items() if file_digest(path) != digest]
+            if changed:
+                reason = f"input {changed[0]} changed" + (f" (and {len(changed) - 1} more)"
+                                                          if len(changed) > 1 else "")
+        if reason is not None:
+            stale = dict.fromkeys(self.targets, reason)
+        else:
+            stale = {target: "output kind not generated before"
+                     for target in self.targets if target not in entry['targets']}
+            for path, output in entry['outputs'].items():
+                if output['target'] not in self.targets or output['target'] in stale:
+                    continue
+                if file_digest(path) != output['digest']:
+                    reason = f"output {path} is missing or was modified"
+                else:
+                    reason = self.template_change(output['templates'])
+                    if reason is not None and output['kinds']:
+                        kinds = sorted({kind for kinds in output['kinds'].values() for kind in kinds})
+                        reason += f" (output renders {', '.join(kinds)})"
+                if reason is not None:
+                    stale[output['target']] = reason
+            stale = {target: stale[target] for target in self.targets if target in stale}
+
+        if stale:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return stale
+
+    def update(self, job):
+        """remember the inputs and outputs of a finished job
+           Jobs with errors are not stored, so they are retried next time.
+           If the job generated only some output kinds and the inputs didn't
+           change, the outputs of the other kinds are kept.
+
+        Args:
+            job (GenerationJob): the finished job
+        """
+        if job.errors:
+            self.entries.pop(job.fidl_file, None)
+            return
+        output_dir = active_generator().output_dir
+        inputs = {path: file_digest(path) for path in job.dependencies}
+        outputs = {}
+        targets = set(job.targets)
+        previous = self.entries.get(job.fidl_file)
+        if previous is not None and previous.get('format') == BUILD_CACHE_FORMAT \
+                and previous['inputs'] == inputs:
+            outputs = {path: output for path, output in previous['outputs'].items()
+                       if output['target'] not in targets}
+            targets.update(previous['targets'])
+        for file_name, _ in job.outputs:
+            path = output_dir + "/" + file_name
+            sources = job.output_sources[file_name]
+            outputs[path] = {
+                'digest': file_digest(path),
+                'target': sources['target'],
+                'templates': {name: [self.templates[name]['dir'], self.templates[name]['digest']]
+                              for name in sorted(self.template_closure(sources['templates']))
+                              if name in self.templates},
+                'kinds': sources['kinds'],
+            }
+        self.entries[job.fidl_file] = {
+            'version': GENERATOR_VERSION,
+            'format': BUILD_CACHE_FORMAT,
+            'targets': [target for target in OUTPUT_KINDS if target in targets],
+            'inputs': inputs,
+            'outputs': outputs,
+        }
+
+    def save(self):
+        """write the cache file"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w', encoding="utf8") as out_file:
+            json.dump(self.entries, out_file, indent=1, sort_keys=True)
+
+
+# ----- Watch mode -----
+# Keeps parsed models and compiled templates in memory and regenerates only
+# the files affected by a change.  Changes are detected by polling mtimes.
+
+
+class ImportGraph:
+    """Which FIDL file imports which, built from packages.imports"""
+
+    def __init__(self):
+        self.imports = {}   # path -> set of directly imported paths
+
+    def add_job(self, job):
+        """add the imports found while processing a file
+
+        Args:
+            job (GenerationJob): a finished job
+        """
+        for path, imported in job.imports.items():
+            self.imports[path] = set(imported)
+
+    def add_dependencies(self, path, dependencies):
+        """add the (transitive) dependencies of a file, e.g. from the build
+           cache, when the file was not processed in this run
+
+        Args:
+            path (filePath): FIDL file
+            dependencies (iterable): files it depends on
+        """
+        self.imports.setdefault(path, set()).update(dep for dep in dependencies if dep != path)
+
+    def paths(self):
+        """all known FIDL files
+
+        Returns:
+            set: absolute paths
+        """
+        known = set(self.imports)
+        for imported in self.imports.values():
+            known.update(imported)
+        return known
+
+    def importers_of(self, paths):
+        """find all files that (transitively) import one of the given files
+
+        Args:
+            paths (iterable): changed files
+
+        Returns:
+            set: the given files and all files depending on them
+        """
+        importers = {}
+        for path, imported in self.imports.items():
+            for dependency in imported:
+                importers.setdefault(dependency, set()).add(path)
+
+        affected = set(paths)
+        todo = list(affected)
+        while todo:
+            for importer in importers.get(todo.pop(), ()):
+                if importer not in affected:
+                    affected.add(importer)
+                    todo.append(importer)
+        return affected
+
+
+def watch_snapshot(paths):
+    """get modification time and size of files
+
+    Args:
+        paths (iterable): files to check
+
+    Returns:
+        dict: path -> (mtime, size) for the existing files
+    """
+    snapshot = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+def watch(generator, patterns, interval, stats):
+    """generate, then regenerate whenever FIDL files or templates change
+       A changed FIDL file regenerates the input files depending on it, a
+       changed template the outputs that used it (see BuildCache; without
+       the cache everything).  Runs until interrupted.
+       The files are generated in this process, so that parsed models and
+       compiled templates stay in memory.
+
+    Args:
+        generator (Generator): the generator to run
+        patterns (list): FIDL files or glob patterns, expanded on every check
+        interval (float): seconds between checks
+        stats (Counter): counts written and unchanged files
+    """
+    graph = ImportGraph()
+    cache = generator.cache
+    generator.jobs = 1
+
+    def regenerate(files):
+        try:
+            for job in generator.generate(files, stats):
+                graph.add_job(job)
+        except Exception as exception:   # keep watching, the next edit may fix it
+            print(f"ERROR: {exception}")
+        if cache is not None:
+            for file in files:
+                if file in cache.entries:
+                    graph.add_dependencies(file, cache.entries[file]['inputs'])
+
+    files = [file for file in expand_inputs(patterns) if os.path.exists(file)]
+    regenerate(files)
+
+    templates = generator.template_search_files()
+    snapshot = watch_snapshot(set(files) | graph.paths() | templates)
+    log(f"Watching {len(files)} FIDL files and the templates, press Ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(interval)
+            files = [file for file in expand_inputs(patterns) if os.path.exists(file)]
+            templates = generator.template_search_files()
+            current = watch_snapshot(set(files) | graph.paths() | templates)
+            changed = {path for path in snapshot.keys() | current.keys()
+                       if snapshot.get(path) != current.get(path)}
+            snapshot = current
+            if not changed:
+                continue
+
+            for path in sorted(changed):
+                log(f"Changed: {path}")
+            # Cached models importing a changed FIDL file are stale
+            affected = graph.importers_of(changed)
+            generator.model_cache.invalidate(affected)
+            if changed - graph.paths() - set(files):
+                # everything that is no FIDL file is a template
+                generator.clear_template_caches()
+                if generator.template_cache_dir is not None:
+                    generator.use_template_cache(generator.template_cache_dir)
+                if cache is not None:
+                    cache.templates = generator.template_states()
+                regenerate(files)
+            else:
+                known = graph.paths()
+                regenerate([file for file in files if file in affected or file not in known])
+            # Only the files found by this run are new, the others keep their
+            # state from before it: edits saved meanwhile are seen next time
+            snapshot.update(watch_snapshot((set(files) | graph.paths() | templates) - snapshot.keys()))
+    except KeyboardInterrupt:
+        pass
+
+
+def expand_inputs(patterns):
+    """expand the FIDL files / glob patterns given on the command line
+
+    Args:
+        patterns (list): file names or glob patterns
+
+    Returns:
+        list: absolute paths, without duplicates, in command line order
+    """
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches and not glob.has_magic(pattern):
+            matches = [pattern]     # let process_file() complain about it
+        for match in matches:
+            path = os.path.abspath(match)
+            if path not in files:
+                files.append(path)
+    return files
+
+
+# ----- Generator -----
+# All state of one generator configuration: template environment and
+# caches, parsed models, output dir and settings.  Several generators can
+# be used in one process (e.g. embedded in a build service), each keeps its
+# compiled templates and parsed models from run to run.  The functions
+# above use the generator that is active in the current context.
+
+
+current_generator = contextvars.ContextVar('current_generator', default=None)
+default_generator = None
+
+
+def active_generator():
+    """the generator of the current context
+       Outside of Generator.activate() that is a default generator, created
+       on first use, writing to src_gen in the working dir.
+
+    Returns:
+        Generator: the active generator
+    """
+    global default_generator
+    generator = current_generator.get()
+    if generator is None:
+        if default_generator is None:
+            default_generator = Generator()
+        generator = default_generator
+    return generator
+
 
+class Generator:
+    """A generator configuration with its own templates, caches and output
 
-def main():
+    Args:
+        output_dir (filePath, optional): dir for generated files. Defaults to
+            src_gen in the working dir.
+        template_dir (filePath, optional): dir with the templates/ override
+            dir. Defaults to the working dir.
+        targets (tuple, optional): output kinds to generate. Defaults to DEFAULT_TARGETS.
+        formatter (string, optional): one of FORMATTERS. Defaults to 'auto'.
+        jobs (int, optional): number of worker processes. Defaults to 1.
+        reproducible (bool, optional): no timestamp in the generated files. Defaults to False.
+        cache (BuildCache, optional): skip files that are up to date. Defaults to None.
+        model_cache (ModelCache, optional): parsed models, can be shared by
+            several generators. Defaults to a new one.
+        template_cache_dir (filePath, optional): precompile the templates
+            into this dir and load them from there. Defaults to None.
+        sink (OutputSink, optional): where the generated files go. Defaults
+            to a DiskSink, writing into output_dir.
+        pipeline (bool, optional): format and write the outputs of each file
+            while the next ones are rendered, see OutputPipeline. The
+            content is then not kept in GenerationJob.outputs. Defaults to False.
+        low_memory (bool, optional): write the outputs of each file right
+            away, keep neither their content nor the type references of the
+            job, and don't keep parsed models in memory (see ModelCache).
+            Defaults to False.
+        explain (bool, optional): print why each file is generated. Defaults to False.
+    """
+
+    def __init__(self, output_dir=None, template_dir=None, targets=DEFAULT_TARGETS, formatter='auto',
+                 jobs=1, reproducible=False, cache=None, model_cache=None, template_cache_dir=None,
+                 sink=None, pipeline=False, low_memory=False, explain=False):
+        if cache is not None and sink is not None and not isinstance(sink, DiskSink):
+            raise ValueError("The build cache checks the files on disk, it needs a DiskSink")
+        self.output_dir = os.path.abspath(output_dir or RELATIVE_OUTPUT_DIR)
+        # Where to find templates.  Every template is resolved and compiled
+        # only once, compiled templates are kept in the environment's
+        # (bounded) cache.
+        self.template_loader = backend().MyLoader(os.path.abspath(template_dir or os.getcwd()),  # preferred
+                                                  basedir,      # fallback/default location
+                                                  'templates',  # relative path
+                                                  resolve_once=True)
+        self.env = backend().Environment(loader=self.template_loader,
+                               cache_size=TEMPLATE_CACHE_SIZE,
+                               auto_reload=False)
+        self.targets = tuple(targets)
+        self.formatter = formatter
+        self.jobs = jobs
+        self.reproducible = reproducible
+        self.cache = cache
+        self.model_cache = model_cache if model_cache is not None else ModelCache(low_memory=low_memory)
+        self.template_cache_dir = template_cache_dir
+        self.sink = sink if sink is not None else DiskSink()
+        self.pipeline = pipeline
+        self.low_memory = low_memory
+        self.explain = explain
+        self.boilerplate = None
+        self.rendered_headers = {}  # types header file name -> files of the owning package
+        self.type_spellings = {}    # (type key, base namespace) -> C++ spelling
+        self.type_spelling_stats = Counter()    # 'hits', 'misses'
+        if template_cache_dir is not None:
+            self.use_template_cache(template_cache_dir)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """make this the generator used in the current context"""
+        token = current_generator.set(self)
+        try:
+            yield self
+        finally:
+            current_generator.reset(token)
+
+    def worker_settings(self):
+        """
+        Returns:
+            dict: picklable settings to create the same generator in a
+                worker process, see configure_worker()
+        """
+        return {'output_dir': self.output_dir,
+                'template_dir': self.template_loader.prioritydir,
+                'targets': self.targets,
+                'formatter': self.formatter,
+                'reproducible': self.reproducible,
+                'low_memory': self.low_memory,
+                'model_cache_dir': self.model_cache.cache_dir,
+                'template_cache_dir': self.template_cache_dir}
+
+    def templates_digest(self):
+        """hash all templates as they would be resolved by the loader,
+           i.e. taking overrides in the priority dir into account
+
+        Returns:
+            string: sha256 hex digest
+        """
+        digest = hashlib.sha256()
+        for name in self.template_loader.list_templates():
+            path = self.template_loader.get_file_location(name)
+            digest.update(f"{name}\0{path}\0".encode())
+            with open(path, 'rb') as in_file:
+                digest.update(in_file.read())
+        return digest.hexdigest()
+
+    def template_states(self):
+        """the state of all templates as they would be resolved by the
+           loader, for the build cache
+
+        Returns:
+            dict: template name -> {'dir': 'priority' or 'default',
+                'digest': sha256 hex digest, 'imports': templates it
+                imports or includes}
+        """
+        loader = self.template_loader
+        names = loader.list_templates()
+        states = {}
+        for name in names:
+            with open(loader.get_file_location(name), 'rb') as in_file:
+                source = in_file.read()
+            imports = []
+            if name.endswith('.tpl'):
+                referenced = list(backend().meta.find_referenced_templates(self.env.parse(source.decode("utf8"))))
+                # A computed template name could be any template
+                imports = names if None in referenced else sorted(set(referenced))
+            states[name] = {'dir': loader.origin(name),
+                            'digest': hashlib.sha256(source).hexdigest(),
+                            'imports': imports}
+        return states
+
+    def template_search_files(self):
+        """all files in both template search dirs used by the loader
+
+        Returns:
+            set: absolute paths
+        """
+        loader = self.template_loader
+        found = set()
+        for searchdir in (loader.prioritydir, loader.defaultdir):
+            root = os.path.abspath(os.path.join(searchdir, loader.relpath))
+            for dirpath, _, filenames in os.walk(root):
+                found.update(os.path.join(dirpath, filename) for filename in filenames)
+        return found
+
+    def clear_template_caches(self):
+        """forget resolved, compiled and read templates, e.g. after they changed"""
+        self.template_loader.clear_cache()
+        self.env.cache.clear()
+        self.boilerplate = None
+
+    def precompile_templates(self, target_dir):
+        """compile all templates (including priority dir overrides) into python
+           modules in target_dir, together with a manifest of the template digest
+
+        Args:
+            target_dir (filePath): dir for the compiled modules
+        """
+        os.makedirs(target_dir, exist_ok=True)
+        for old_module in glob.glob(os.path.join(target_dir, "tmpl_*.py")):
+            os.remove(old_module)
+        compiler = backend().Environment(loader=self.template_loader)
+        compiler.compile_templates(target_dir, zip=None, ignore_errors=False,
+                                   filter_func=lambda name: name.endswith('.tpl'))
+        with open(os.path.join(target_dir, TEMPLATE_CACHE_MANIFEST), 'w', encoding="utf8") as out_file:
+            out_file.write(self.templates_digest())
+
+    def use_template_cache(self, cache_dir):
+        """load templates from precompiled modules, compiling them first if the
+           templates changed since the modules were built
+
+        Args:
+            cache_dir (filePath): dir for the compiled modules
+        """
+        try:
+            with open(os.path.join(cache_dir, TEMPLATE_CACHE_MANIFEST), 'r', encoding="utf8") as in_file:
+                up_to_date = in_file.read() == self.templates_digest()
+        except FileNotFoundError:
+            up_to_date = False
+        if not up_to_date:
+            log(f"Precompiling templates into {cache_dir}")
+            self.precompile_templates(cache_dir)
+
+        self.env.loader = backend().ChoiceLoader([backend().ModuleLoader(cache_dir), self.template_loader])
+        self.env.cache.clear()
+
+    def generate(self, paths, stats=None, report=None, dependency_index=None):
+        """process FIDL files, in worker processes if jobs > 1
+           The outputs of all files are collected and then formatted and
+           written together.  If a file is generated more than once (e.g. the
+           types of an imported package), the last one wins, just like in a
+           serial run.
+
+        Args:
+            paths (list): FIDL files or glob patterns
+            stats (Counter, optional): counts written and unchanged files. Defaults to None.
+            report (TimingReport, optional): collects stage timings. Defaults to None.
+            dependency_index (DependencyIndex, optional): collects the type
+                references of all files. Defaults to None.
+
+        Returns:
+            list: GenerationJob per processed file
+        """
+        if stats is None:
+            stats = Counter()
+        if report is None:
+            report = TimingReport()
+        files = expand_inputs(paths)
+        # Output kinds to generate per file, with the build cache only the
+        # outdated ones
+        targets = dict.fromkeys(files, self.targets)
+        for file in files:
+            if self.cache is None:
+                if self.explain:
+                    log(f"Generate {file}: no build cache")
+                continue
+            stale = self.cache.stale_targets(file)
+            if not stale:
+                log(f"Up to date: {file}")
+                del targets[file]
+                continue
+            targets[file] = tuple(stale)
+            if self.explain:
+                for target, reason in stale.items():
+                    log(f"Generate {file} [{target}]: {reason}")
+        files = list(targets)
+
+        with self.activate(), contextlib.ExitStack() as stack:
+            self.rendered_headers.clear()
+            self.type_spellings.clear()
+            self.type_spelling_stats.clear()
+            # One timestamp for all files of the run
+            timestamp = generation_timestamp()
+            if self.jobs > 1 and len(files) > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                pool = stack.enter_context(ProcessPoolExecutor(max_workers=min(self.jobs, len(files)),
+                                                               initializer=configure_worker,
+                                                               initargs=(self.worker_settings(),)))
+                # Neighbouring files often import the same models, in chunks
+                # they go to the same worker and those models are parsed once.
+                # Finished jobs hold all their outputs, so only about
+                # PIPELINE_QUEUE_SIZE files are in flight.
+                chunksize = max(1, min(len(files) // (self.jobs * 4), PIPELINE_QUEUE_SIZE // self.jobs))
+                chunks = ((files[start:start + chunksize],
+                           [targets[file] for file in files[start:start + chunksize]], timestamp)
+                          for start in range(0, len(files), chunksize))
+                jobs = chain.from_iterable(map_bounded(pool, process_files, chunks,
+                                                       max(self.jobs, PIPELINE_QUEUE_SIZE // chunksize)))
+            else:
+                jobs = (process_file(file, targets[file], timestamp) for file in files)
+            pipeline = None
+            if self.pipeline:
+                pipeline = stack.enter_context(OutputPipeline(self, stats, report))
+
+            results = []
+            outputs = {}
+            sent = set()    # file names streamed to the pipeline or written
+            registry = TypeRegistry()
+            # Content that doesn't go to disk isn't formatted on disk either
+            stdin = not isinstance(self.sink, DiskSink)
+            for job in jobs:
+                results.append(job)
+                report.add_job(job)
+                registry.add_job(job)
+                if dependency_index is not None:
+                    dependency_index.merge(job.dependency_index)
+                if pipeline is not None or self.low_memory:
+                    # Workers render the shared types headers each, only the
+                    # first copy goes out (a serial run renders it once)
+                    new_outputs = [(file_name, content) for file_name, content in job.outputs
+                                   if file_name not in sent]
+                    sent.update(file_name for file_name, _ in new_outputs)
+                if pipeline is not None:
+                    pipeline.put(new_outputs)
+                elif self.low_memory:
+                    write_outputs(format_outputs(dict(new_outputs), self.formatter, report, stdin),
+                                  stats, report)
+                else:
+                    outputs.update(job.outputs)
+                if pipeline is not None or self.low_memory:
+                    # The content is written (or queued) already
+                    job.outputs = [(file_name, None) for file_name, _ in job.outputs]
+                if self.low_memory:
+                    job.dependency_index.clear()
+            registry.report()
+            if pipeline is None and not self.low_memory:
+                write_outputs(format_outputs(outputs, self.formatter, report, stdin), stats, report)
+            else:
+                # Wait for the last writes, the cache checks the written files
+                stack.pop_all().close()
+
+            if self.cache is not None:
+                for job in results:
+                    self.cache.update(job)
+                self.cache.save()
+        return results
+
+
+def write_outputs(outputs, stats, report):
+    """pass the final content of all generated files to the sink of the
+       active generator
+
+    Args:
+        outputs (dict): file name -> final content
+        stats (Counter): counts written and unchanged files
+        report (TimingReport): collects stage timings
+    """
+    generator = active_generator()
+    generator.sink.prepare(generator.output_dir, outputs)
+    for file_name, result in outputs.items():
+        with report.stage(file_name, 'write_result_file'):
+            written = generator.sink.write(generator.output_dir, file_name, result)
+        if written:
+            stats['written'] += 1
+        else:
+            stats['unchanged'] += 1
+
+
+class OutputPipeline:
+    """Format and write the outputs of finished jobs while the next jobs are
+       rendered
+       A stage thread takes whatever outputs are queued (up to
+       CLANG_FORMAT_BATCH_SIZE files, so clang-format still runs in
+       batches) and formats and writes them with format_outputs() and
+       write_outputs(), in the order they were put.  The queue is bounded:
+       when formatting and writing fall behind, put() blocks.
+
+       Use as context manager, leaving it waits until everything is written.
+
+    Args:
+        generator (Generator): formatter, output dir and sink
+        stats (Counter): counts written and unchanged files
+        report (TimingReport): collects stage timings
+    """
+
+    def __init__(self, generator, stats, report):
+        self.generator = generator
+        self.stats = stats
+        self.report = report
+        self.queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.error = None
+        # format_outputs() and write_outputs() use the active generator
+        self.thread = threading.Thread(target=contextvars.copy_context().run, args=(self.run,),
+                                       name="pyfranca_cpp output")
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None and exc_info[0] is None:
+            raise self.error
+
+    def put(self, outputs):
+        """queue the outputs of one job, blocks while the queue is full
+
+        Args:
+            outputs (list): (file name, generated content)
+        """
+        self.queue.put(outputs)
+
+    def batches(self):
+        """
+        Yields:
+            dict: file name -> generated content, of the jobs queued so far
+        """
+        done = False
+        while not done:
+            batch = {}
+            outputs = self.queue.get()
+            while outputs is not None:
+                batch.update(outputs)
+                if len(batch) >= CLANG_FORMAT_BATCH_SIZE:
+                    break
+                try:
+                    outputs = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            done = outputs is None
+            if batch:
+                yield batch
+
+    def run(self):
+        """format and write until put() of None
+           After an error the queue is still emptied, so that put() can't
+           block forever.
+        """
+        stdin = not isinstance(self.generator.sink, DiskSink)
+        for batch in self.batches():
+            if self.error is not None:
+                continue
+            try:
+                outputs = format_outputs(batch, self.generator.formatter, self.report, stdin)
+                write_outputs(outputs, self.stats, self.report)
+            except BaseException as exception:     # raised again by __exit__
+                self.error = exception
+
+
+# ----- Manifest mode -----
+# A manifest (TOML, or JSON with the same structure) describes a whole
+# tree of FIDL files.  Top level values are defaults for all [[inputs]]:
+#
+#   targets = ["types", "interface"]
+#
+#   [[inputs]]
+#   root = "idl/navigation"
+#   globs = ["**/*.fidl"]
+#   output_dir = "src_gen/navigation"
+#   template_dir = "idl/navigation"     # overrides in idl/navigation/templates
+#
+# Relative paths are relative to the manifest.  Everything runs in this
+# interpreter, so models imported by many files are parsed only once.
+
+
+MANIFEST_KEYS = ('root', 'globs', 'output_dir', 'template_dir', 'targets')
+
+
+def load_manifest(path, default_targets=DEFAULT_TARGETS):
+    """read a manifest file
+
+    Args:
+        path (filePath): .toml or .json manifest
+        default_targets (tuple, optional): targets if the manifest has none.
+            Defaults to DEFAULT_TARGETS.
+
+    Returns:
+        list: one dict per [[inputs]] entry with all MANIFEST_KEYS, absolute paths
+
+    Raises:
+        ValueError: the manifest is invalid
+    """
+    if path.endswith('.json'):
+        with open(path, 'r', encoding="utf8") as in_file:
+            data = json.load(in_file)
+    else:
+        try:
+            import tomllib
+        except ImportError:     # python < 3.11, only JSON manifests then
+            raise ValueError(f"{path}: TOML manifests need python 3.11, use JSON instead") from None
+        with open(path, 'rb') as in_file:
+            data = tomllib.load(in_file)
+
+    base = os.path.dirname(os.path.abspath(path))
+    defaults = {'root': '.', 'globs': ['**/*.fidl'], 'output_dir': RELATIVE_OUTPUT_DIR,
+                'template_dir': None, 'targets': list(default_targets)}
+    entries = data.pop('inputs', [{}])
+    groups = []
+    for entry in [data] + entries:
+        unknown = set(entry) - set(MANIFEST_KEYS)
+        if unknown:
+            raise ValueError(f"{path}: unknown key(s) {', '.join(sorted(unknown))}")
+    for entry in entries:
+        group = dict(defaults, **data)
+        group.update(entry)
+        for key in ('globs', 'targets'):
+            if isinstance(group[key], str):
+                group[key] = [group[key]]
+        for key in ('root', 'output_dir', 'template_dir'):
+            if group[key] is not None:
+                group[key] = os.path.normpath(os.path.join(base, group[key]))
+        try:
+            group['targets'] = parse_targets(",".join(group['targets']))
+        except argparse.ArgumentTypeError as exception:
+            raise ValueError(f"{path}: {exception}") from exception
+        groups.append(group)
+    return groups
+
+
+def glob_regex(pattern):
+    """compile a glob pattern for paths relative to an input root
+       '**' matches any number of directories, '*' and '?' stay within one.
+
+    Args:
+        pattern (string): glob pattern, '/' separated
+
+    Returns:
+        re.Pattern: regular expression matching the whole path
+    """
+    regex = []
+    for part in re.split(r"(\*\*/|\*\*|\*|\?)", pattern):
+        if part == "**/":
+            regex.append("(?:.*/)?")
+        elif part == "**":
+            regex.append(".*")
+        elif part == "*":
+            regex.append("[^/]*")
+        elif part == "?":
+            regex.append("[^/]")
+        else:
+            regex.append(re.escape(part))
+    return re.compile("".join(regex))
+
+
+def discover_manifest_files(groups):
+    """find the input files of all manifest entries
+       Every directory is walked only once, also if roots are nested.
+
+    Args:
+        groups (list): entries from load_manifest()
+
+    Returns:
+        list: sorted list of matching files per entry
+    """
+    roots = sorted({group['root'] for group in groups})
+    walk_roots = [root for root in roots
+                  if not any(root.startswith(other + os.sep) for other in roots)]
+    found = []
+    for root in walk_roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            found.extend(os.path.join(dirpath, filename) for filename in sorted(filenames))
+
+    matches = []
+    for group in groups:
+        patterns = [glob_regex(pattern) for pattern in group['globs']]
+        prefix = group['root'] + os.sep
+        matches.append([path for path in found if path.startswith(prefix)
+                        and any(pattern.fullmatch(path[len(prefix):].replace(os.sep, '/'))
+                                for pattern in patterns)])
+    return matches
+
+
+IMPORT_PATTERN = re.compile(r'^\s*import\b[^"\n]*"([^"]+)"', re.MULTILINE)
+
+
+def scan_imports(path):
+    """find the files a FIDL file imports, without parsing it
+       Looked up like CachingProcessor.import_file() does.
+
+    Args:
+        path (filePath): absolute path to the FIDL file
+
+    Returns:
+        list: absolute paths of the imported files that exist
+    """
+    try:
+        with open(path, 'r', encoding="utf8") as in_file:
+            fidl_text = in_file.read()
+    except (OSError, UnicodeDecodeError):
+        return []
+    imported = []
+    for fspec in IMPORT_PATTERN.findall(fidl_text):
+        for searchdir in (os.path.dirname(path), os.getcwd()):
+            candidate = os.path.abspath(os.path.join(searchdir, fspec))
+            if os.path.exists(candidate):
+                imported.append(candidate)
+                break
+    return imported
+
+
+def import_groups(files):
+    """group FIDL files that (indirectly) import the same models
+
+    Args:
+        files (list): absolute paths to FIDL files
+
+    Returns:
+        list: lists of files, groups and files in order of first appearance
+    """
+    parent = {}
+
+    def find(path):
+        parent.setdefault(path, path)
+        while parent[path] != path:
+            parent[path] = parent[parent[path]]
+            path = parent[path]
+        return path
+
+    scanned = set()
+    pending = list(files)
+    while pending:
+        path = pending.pop()
+        if path in scanned:
+            continue
+        scanned.add(path)
+        for imported in scan_imports(path):
+            parent[find(imported)] = find(path)
+            pending.append(imported)
+
+    groups = {}
+    for file in files:
+        groups.setdefault(find(file), []).append(file)
+    return list(groups.values())
+
+
+def run_manifest(path, base, template_cache_dir=None, use_cache=True, stats=None,
+                 report=None, dependency_index=None):
+    """generate all inputs of a manifest
+       Entries with the same output dir, template dir and targets are
+       generated together by one Generator, their files ordered by import
+       group.  All generators share the parsed models.
+
+    Args:
+        path (filePath): manifest file
+        base (Generator): jobs, formatter, reproducible mode, model cache,
+            sink, pipelined and low-memory mode, --explain and default targets
+            for all entries
+        template_cache_dir (filePath, optional): dir for precompiled templates,
+            one subdir per template dir. Defaults to None.
+        use_cache (bool, optional): use a build cache per output dir. Defaults to True.
+        stats (Counter, optional): counts written and unchanged files. Defaults to None.
+        report (TimingReport, optional): collects stage timings. Defaults to None.
+        dependency_index (DependencyIndex, optional): collects the type
+            references of all files. Defaults to None.
+
+    Returns:
+        tuple: (list of GenerationJob, list of BuildCache)
+    """
+    groups = load_manifest(path, base.targets)
+    settings = {}
+    for group, files in zip(groups, discover_manifest_files(groups)):
+        key = (group['output_dir'], group['template_dir'] or os.getcwd(), group['targets'])
+        selected = settings.setdefault(key, [])
+        selected.extend(file for file in files if file not in selected)
+
+    results = []
+    caches = []
+    for (output_dir, template_dir, targets), files in settings.items():
+        files = [file for group in import_groups(files) for file in group]
+        log(f"Manifest: {len(files)} files -> {output_dir} ({', '.join(targets)})")
+        cache_dir = None
+        if template_cache_dir is not None:
+            cache_dir = os.path.join(template_cache_dir,
+                                     hashlib.sha256(template_dir.encode()).hexdigest()[:16])
+        generator = Generator(output_dir, template_dir, targets, base.formatter, base.jobs,
+                              base.reproducible, model_cache=base.model_cache,
+                              template_cache_dir=cache_dir, sink=base.sink, pipeline=base.pipeline,
+                              low_memory=base.low_memory, explain=base.explain)
+        if use_cache and isinstance(base.sink, DiskSink):
+            generator.cache = BuildCache(os.path.join(output_dir, BUILD_CACHE_FILE),
+                                         generator.template_states(), targets)
+            caches.append(generator.cache)
+        results.extend(generator.generate(files, stats, report, dependency_index))
+    return results, caches
+
+
+def parse_targets(value):
+    """parse a comma separated list of output kinds
+
+    Args:
+        value (string): e.g. "types,interface"
+
+    Returns:
+        tuple: selected kinds, in the order of OUTPUT_KINDS
+
+    Raises:
+        argparse.ArgumentTypeError: unknown output kind
+    """
+    selected = {target.strip() for target in value.split(",") if target.strip()}
+    unknown = selected - set(OUTPUT_KINDS)
+    if unknown or not selected:
+        raise argparse.ArgumentTypeError(
+            f"unknown target(s) {', '.join(sorted(unknown)) or value!r}, "
+            f"choose from {', '.join(OUTPUT_KINDS)}")
+    return tuple(target for target in OUTPUT_KINDS if target in selected)
+
+
+def parse_arguments(argv):
+    """parse the command line
+
+    Args:
+        argv (list): command line arguments (without program name)
+
+    Returns:
+        argparse.Namespace: parsed arguments
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('fidl_files', nargs='*', metavar='FIDL',
+                        help="FIDL files or glob patterns (e.g. 'idl/**/*.fidl')")
+    parser.add_argument('--manifest', metavar='FILE',
+                        help="generate the inputs listed in a TOML or JSON manifest, "
+                        "with their own output dirs, template dirs and targets")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of worker processes, 0 for one per CPU (default: 1)")
+    parser.add_argument('-o', '--output-dir', default=RELATIVE_OUTPUT_DIR,
+                        help=f"directory for generated files (default: {RELATIVE_OUTPUT_DIR})")
+    parser.add_argument('--cache', metavar='FILE',
+                        help=f"build cache file (default: OUTPUT_DIR/{BUILD_CACHE_FILE})")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="regenerate all files, ignoring the build cache")
+    parser.add_argument('--model-cache', metavar='DIR',
+                        help="keep pickled FIDL models in DIR, so unchanged files are "
+                        "not parsed again in the next run")
+    parser.add_argument('--template-cache', metavar='DIR',
+                        help="precompile the templates (including overrides) into python "
+                        "modules in DIR and load them from there; recompiled when templates change")
+    parser.add_argument('--targets', type=parse_targets, default=DEFAULT_TARGETS,
+                        metavar='KIND[,KIND...]',
+                        help=f"output kinds to generate, from {', '.join(OUTPUT_KINDS)} "
+                        "(default: all)")
+    parser.add_argument('--formatter', choices=FORMATTERS, default='auto',
+                        help="how to format the generated code; 'auto' uses clang-format "
+                        "if installed, else the built-in 'python' formatter (default: auto)")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="format and write the outputs of finished files while the next "
+                        "files are rendered")
+    parser.add_argument('--low-memory', action='store_true',
+                        help="lower the peak memory of big models: write the outputs of each "
+                        "file right away, don't keep parsed models in memory, compact the ASTs")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep running and regenerate the affected files whenever "
+                        "a FIDL file or template changes")
+    parser.add_argument('--watch-interval', type=float, default=1.0, metavar='SECONDS',
+                        help="time between checks for changes in watch mode (default: 1.0)")
+    parser.add_argument('--timings', metavar='FILE',
+                        help="write per file, per stage timings as JSON to FILE")
+    parser.add_argument('--profile', choices=('cpu', 'memory'),
+                        help="profile the run with cProfile (cpu) or tracemalloc (memory); "
+                        "only covers worker processes with --jobs 1")
+    parser.add_argument('--profile-output', metavar='FILE',
+                        help="profile output (default: pyfranca_cpp.prof / pyfranca_cpp.memory.txt)")
+    parser.add_argument('--reproducible', action='store_true',
+                        help="byte-identical output for identical inputs: no timestamp in "
+                        "the generated files, unless SOURCE_DATE_EPOCH is set")
+    parser.add_argument('--dependency-graph', metavar='FILE',
+                        help="write the type reference graph to FILE, as Graphviz DOT "
+                        "if FILE ends with .dot, else as JSON; all files are processed, "
+                        "the build cache is not used")
+    parser.add_argument('--explain', action='store_true',
+                        help="print why each file is generated: changed inputs, outputs or "
+                        "templates (per output kind), or no build cache")
+    parser.add_argument('--stats', action='store_true',
+                        help="print cache and output statistics at the end")
+    sink = parser.add_mutually_exclusive_group()
+    sink.add_argument('--archive', metavar='FILE',
+                      help="write the generated files into a tar (.tar, .tar.gz, .tgz, .tar.xz, "
+                      ".tar.bz2) or zip archive instead of OUTPUT_DIR; '-' for a tar on stdout")
+    sink.add_argument('--stdout-manifest', action='store_true',
+                      help="print the generated files as JSON lines (name, size, sha256, "
+                      "content) to stdout instead of writing them")
+    args = parser.parse_args(argv)
+    if not args.fidl_files and not args.manifest:
+        parser.error("no FIDL files given (and no --manifest)")
+    if args.manifest and args.watch:
+        parser.error("--watch can't be combined with --manifest")
+    if args.manifest and args.cache:
+        parser.error("--cache can't be combined with --manifest, every entry has "
+                     "the build cache in its output dir")
+    if args.watch and (args.archive or args.stdout_manifest):
+        parser.error("--watch writes to OUTPUT_DIR, it can't be combined with "
+                     "--archive or --stdout-manifest")
+    try:
+        source_date_epoch()
+    except ValueError as exception:
+        parser.error(str(exception))
+    return args
+
+
+def open_sink(args, stack):
+    """create the sink selected on the command line
+
+    Args:
+        args (argparse.Namespace): parsed arguments
+        stack (contextlib.ExitStack): closes the sink (and gives back
+            stdout) at the end
+
+    Returns:
+        OutputSink: the sink, None for the default DiskSink
+    """
+    if not args.archive and not args.stdout_manifest:
+        return None
+    stream = None
+    if args.stdout_manifest or args.archive == "-":
+        stream = stack.enter_context(reserved_stdout())
+    # Entries are named relative to the manifest, or the output dir
+    root = os.path.dirname(os.path.abspath(args.manifest)) if args.manifest else args.output_dir
+    if args.archive:
+        sink = ArchiveSink(args.archive, root, stream)
+    else:
+        sink = ManifestSink(stream, root)
+    stack.callback(sink.close)
+    return sink
+
+
+def main(argv=None):
     """main function
 
-       FIDL_FILES must contain a list of files to be parsed.
+    Args:
+        argv (list, optional): command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        int: exit status
     """
-    for files in FIDL_FILES:
-        log("-------------------------------------------------------")
-        log(" ----- PROCESSING %s -----" % files)
-        log("-------------------------------------------------------")
-        process_file(files)
+    args = parse_arguments(argv)
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    model_cache = ModelCache(os.path.abspath(args.model_cache) if args.model_cache else None,
+                             args.low_memory)
+    template_cache_dir = os.path.abspath(args.template_cache) if args.template_cache else None
+
+    with contextlib.ExitStack() as stack:
+        sink = open_sink(args, stack)
+
+        # In manifest mode this only supplies the defaults, the manifest
+        # entries get generators of their own
+        generator = Generator(args.output_dir, targets=args.targets, formatter=args.formatter,
+                              jobs=jobs, reproducible=args.reproducible, model_cache=model_cache,
+                              template_cache_dir=None if args.manifest else template_cache_dir,
+                              sink=sink, pipeline=args.pipeline, low_memory=args.low_memory,
+                              explain=args.explain)
+        # Files skipped by the build cache would be missing in the graph
+        use_cache = not args.no_cache and not args.dependency_graph
+        if use_cache and not args.manifest and sink is None:
+            cache_file = os.path.abspath(args.cache or generator.output_dir + "/" + BUILD_CACHE_FILE)
+            generator.cache = BuildCache(cache_file, generator.template_states(), args.targets)
+
+        stats = Counter()
+        if args.watch:
+            watch(generator, args.fidl_files, args.watch_interval, stats)
+            return 0
+
+        report = TimingReport()
+        dependency_index = DependencyIndex()
+        profile_output = args.profile_output or \
+            ('pyfranca_cpp.prof' if args.profile == 'cpu' else 'pyfranca_cpp.memory.txt')
+        caches = [generator.cache] if generator.cache is not None else []
+        with profiled(args.profile, profile_output):
+            if args.manifest:
+                try:
+                    results, caches = run_manifest(args.manifest, generator, template_cache_dir,
+                                                   use_cache, stats, report, dependency_index)
+                except (OSError, ValueError) as exception:
+                    print(f"ERROR: {exception}")
+                    return 1
+            else:
+                results = generator.generate(args.fidl_files, stats, report, dependency_index)
+        if args.timings:
+            report.write(args.timings)
+        if args.dependency_graph:
+            dependency_index.write(args.dependency_graph)
+
+        if args.stats:
+            if caches:
+                log(f"Cache: {sum(cache.hits for cache in caches)} hits, "
+                    f"{sum(cache.misses for cache in caches)} misses")
+            log(f"Files: {stats['written']} written, {stats['unchanged']} unchanged")
+            log(f"Model cache: {sum(job.parse_time_saved for job in results):.3f} s parse time saved")
+            spelling_stats = sum((job.type_spelling_stats for job in results), Counter())
+            lookups = spelling_stats['hits'] + spelling_stats['misses']
+            if lookups:
+                log(f"Type spellings: {spelling_stats['hits']} hits, {spelling_stats['misses']} misses "
+                    f"({spelling_stats['hits'] / lookups:.0%} hit rate)")
+
+        if any(job.errors for job in results):
+            return 1
+        return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
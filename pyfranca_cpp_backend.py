@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+
+# -*- coding: utf-8 -*-
+# vim: tw = 0
+# vim: set fileencoding = utf-8
+
+"""
+The parts of the generator built on pyfranca and jinja2
+Imported by pyfranca_cpp.backend() on first use, importing both takes most
+of the start-up time.
+"""
+
+import os
+import copy
+
+# Also used by pyfranca_cpp, through backend()
+import pyfranca
+from pyfranca import Processor, Parser, LexerException, ParserException, ProcessorException, ast
+from jinja2 import Environment, BaseLoader, ChoiceLoader, ModuleLoader, TemplateNotFound, meta
+
+# Pickled models are only valid for the pyfranca version that created them
+PYFRANCA_VERSION = getattr(pyfranca, '__version__', 'unknown')
+
+# Raised by pyfranca for invalid FIDL files
+MODEL_ERRORS = (LexerException, ParserException, ProcessorException)
+
+# From jinja2 docs
+
+
+class MyLoader(BaseLoader):
+    """load the templates
+
+    Args:
+        BaseLoader (baseLoader): jinja baseLoader
+    """
+
+    def __init__(self, prioritydir, defaultdir, relpath, resolve_once=False):
+        self.relpath = relpath
+        self.prioritydir = prioritydir  # Use file from here, if it exists
+        self.defaultdir = defaultdir    # else from here.
+        # Look up every template location only once and don't check for
+        # modifications.  clear_cache() forgets the locations again.
+        self.resolve_once = resolve_once
+        self.locations = {}
+
+    def get_source(self, environment, template):
+        path = self.get_file_location(template)
+
+        try:
+            with open(path, encoding='utf-8') as in_file:
+                source = in_file.read()
+        except FileNotFoundError:
+            raise TemplateNotFound(template) from None
+
+        if self.resolve_once:
+            return source, path, lambda: True
+        mtime = os.path.getmtime(path)
+        return source, path, lambda: mtime == os.path.getmtime(path)
+
+    def get_file_location(self, name):
+        """get the location of the file, when the full name is given
+
+        Args:
+            name (string): full path to file
+
+        Returns:
+            string: directory of the given file
+        """
+        if name in self.locations:
+            return self.locations[name]
+
+        preferred = os.path.abspath(os.path.join(self.prioritydir, self.relpath, name))
+        fallback = os.path.abspath(os.path.join(self.defaultdir, self.relpath, name))
+
+        if os.path.exists(preferred):
+            path = preferred
+        else:
+            path = fallback
+        if self.resolve_once:
+            self.locations[name] = path
+        return path
+
+    def origin(self, name):
+        """
+        Args:
+            name (string): template name
+
+        Returns:
+            string: 'priority' if the priority dir overrides the template, else 'default'
+        """
+        fallback = os.path.abspath(os.path.join(self.defaultdir, self.relpath, name))
+        return 'default' if self.get_file_location(name) == fallback else 'priority'
+
+    def clear_cache(self):
+        """forget the resolved template locations"""
+        self.locations.clear()
+
+    def list_templates(self):
+        """list the templates found in the priority and the default dir
+
+        Returns:
+            list: sorted template names, relative to the template dir
+        """
+        found = set()
+        for searchdir in (self.prioritydir, self.defaultdir):
+            root = os.path.join(searchdir, self.relpath)
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    name = os.path.relpath(os.path.join(dirpath, filename), root)
+                    found.add(name.replace(os.sep, '/'))
+        return sorted(found)
+
+
+def read_fidl_file(path):
+    """read a FIDL file and prepare its text for the parser
+
+    Args:
+        path (filePath): path to FIDL file
+
+    Returns:
+        string: FIDL text
+    """
+    with open(path, "r", encoding="utf8") as in_file:
+        file_content = in_file.read().replace('\r\n', '\n')  # Need to get rid of Windows linefeeds
+    return file_content.replace('^version', 'interfaceversion') \
+        # FIXME, dirty fix of ^ escape character
+
+
+class CachingProcessor(Processor):
+    """pyfranca Processor that takes the parsed packages from a ModelCache
+
+    Args:
+        model_cache (ModelCache): shared parsed models
+    """
+
+    def __init__(self, model_cache):
+        super().__init__()
+        self.model_cache = model_cache
+        self.models_reused = 0
+        self.parse_time_saved = 0.0
+
+    def _cached_package(self, path, fidl_text):
+        package, saved = self.model_cache.package(path, fidl_text)
+        if saved > 0:
+            self.models_reused += 1
+            self.parse_time_saved += saved
+        return package
+
+    def import_string(self, fspec, fidl, references=None):
+        package = self._cached_package(os.path.abspath(fspec), fidl)
+        self.import_package(fspec, package, references)
+        return package
+
+    def import_file(self, fspec, references=None, package_path=None):
+        # Same lookup as Processor.import_file(), but parsing is replaced.
+        # Relative imports are looked up next to the importing file first;
+        # we don't chdir() to it, so the working dir must not win.
+        if fspec in self.files:
+            return self.files[fspec]
+        if os.path.isabs(fspec):
+            if not os.path.exists(fspec):
+                raise ProcessorException(f"Model '{fspec}' not found.")
+        else:
+            package_paths = self.package_paths[:]
+            if package_path:
+                package_paths.insert(0, package_path)
+            package_paths.insert(1 if package_path else 0, os.getcwd())
+            for path in package_paths:
+                if os.path.exists(os.path.join(path, fspec)):
+                    fspec = os.path.join(path, fspec)
+                    break
+            else:
+                raise ProcessorException(f"Model '{fspec}' not found.")
+        path = os.path.abspath(fspec)
+        package = self._cached_package(path, read_fidl_file(path))
+        self.import_package(path, package, references)
+        return package
+
+    def import_package(self, fspec, package, references=None):
+        existing = self.packages.get(package.name)
+        if existing is not None and fspec not in existing.files:
+            # The same package spread over several files: merging would
+            # modify the shared ASTs, so merge private copies instead.
+            self.packages[package.name] = copy.deepcopy(existing)
+            package = copy.deepcopy(package)
+        super().import_package(fspec, package, references)
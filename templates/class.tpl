@@ -1,5 +1,7 @@
 // Generated from Franca IDL Interface {{ fqn }}
+{%- if timestamp %}
 // {{ timestamp }}
+{%- endif %}
 
 {{ boilerplate }}
 
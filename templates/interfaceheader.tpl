@@ -1,7 +1,9 @@
 {% import 'macros/doxygen.tpl' as doxygen %}
 #pragma once
 // Generated from Franca IDL Interface {{ fqn }}
+{%- if timestamp %}
 // {{ timestamp }}
+{%- endif %}
 
 {{ boilerplate }}
 
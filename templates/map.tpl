@@ -2,6 +2,6 @@
     of the type, no object.   would not expect this to work if one of the
     types were unnamed array type (for example)  -#}
  /**< {{ item.comments['@description'] }} */
-typedef std::map<{{ item.key_type.name }}, {{ item.value_type.name }}> {{ item.name }};
+typedef std::map<{{ render_type_name(item.key_type) }}, {{ render_type_name(item.value_type) }}> {{ item.name }};
 
 
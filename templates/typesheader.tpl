@@ -1,6 +1,8 @@
 #pragma once
 // Generated from Franca IDL Interface {{ fqn }}
+{%- if timestamp %}
 // {{ timestamp }}
+{%- endif %}
 
 {{ boilerplate }}
 
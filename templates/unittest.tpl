@@ -1,4 +1,30 @@
+{#- gMock needs parentheses around types with commas, e.g. std::map<K, V> -#}
+{%- macro mock_type(type) -%}
+{{ '(' ~ type ~ ')' if ',' in type else type }}
+{%- endmacro -%}
+#pragma once
+// Generated from Franca IDL Interface {{ fqn }}
+{%- if timestamp %}
+// {{ timestamp }}
+{%- endif %}
+
+#include <gmock/gmock.h>
 #include <gtest/gtest.h>
-#include "{{name}}.h"
+#include "i{{name}}.h"
+
+class Mock{{ name }}: public i{{ name }}
+{
+    public:
+    {%- for m in item.methods.values() %}
+    MOCK_METHOD(void, {{ m.name }}, (
+        {%- set maybecomma = joiner(", ") %}
+        {%- for p in m.in_args.values() -%}
+            {{ maybecomma() }}{{ mock_type(render_type(p)) }}
+        {%- endfor %}
+        {%- for p in m.out_args.values() -%}
+            {{ maybecomma() }}{{ mock_type(render_type(p) ~ " &") }}
+        {%- endfor -%}
+    ), (override));
+    {%- endfor %}
+};
 
-__GENERATED_GOOGLE_MOCK__
\ No newline at end of file
@@ -0,0 +1,263 @@
+
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import benchmark
+import pyfranca_cpp
+from pyfranca_cpp import (ArchiveSink, BuildCache, CircularReferenceError, DependencyIndex, Generator,
+                          MemorySink, map_bounded, reorder_types, strongly_connected_components)
+
+
+def small_corpus(target_dir):
+    return benchmark.write_corpus(str(target_dir), type_collections=2, interfaces=2, methods=5,
+                                  structs=5, chain=2, arrays=2, maps=1, imports=2)
+
+
+def test_model_cache_drops_importers_of_changed_files(tmp_path):
+    files = small_corpus(tmp_path)
+    generator = Generator(str(tmp_path / "out"), formatter='none', sink=MemorySink())
+    jobs = generator.generate(files[:1])
+    assert [job.errors for job in jobs] == [[]]
+
+    types_file = tmp_path / "types0.fidl"
+    types_file.write_text(types_file.read_text().replace("struct T0S4 ", "struct T0S4Renamed "))
+    jobs = generator.generate(files[:1])
+    assert any("Unresolved reference 'T0S4'" in error for job in jobs for error in job.errors)
+
+
+def test_map_bounded_limits_calls_in_flight():
+    started = []
+    lock = threading.Lock()
+
+    def call(number):
+        with lock:
+            started.append(number)
+        return number * 2
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        results = map_bounded(pool, call, ((number,) for number in range(20)), 3)
+        assert next(results) == 0
+        pool.submit(lambda: None).result()  # runs after the submitted calls
+        assert len(started) == 3
+        assert list(results) == [number * 2 for number in range(1, 20)]
+
+
+def test_output_is_reproducible():
+    # Fresh processes with different hash seeds, serial and with workers
+    assert benchmark.check_reproducible(['small'], 2)
+
+
+def test_invalid_source_date_epoch_is_rejected(tmp_path, monkeypatch, capsys):
+    files = small_corpus(tmp_path)
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', 'abc')
+    with pytest.raises(SystemExit) as exit_info:
+        pyfranca_cpp.main(['--no-cache', '-o', str(tmp_path / "out")] + files)
+    assert exit_info.value.code == 2
+    assert "SOURCE_DATE_EPOCH must be a number" in capsys.readouterr().err
+
+
+@pytest.mark.slow
+def test_low_memory_peak_stays_within_budget():
+    assert benchmark.check_memory_budget(benchmark.MEMORY_BUDGET_MB)
+
+
+def test_manifest_accepts_single_strings(tmp_path):
+    manifest = tmp_path / "generate.json"
+    manifest.write_text('{"targets": "types", "inputs": [{"globs": "*.fidl"}]}')
+    groups = pyfranca_cpp.load_manifest(str(manifest))
+    assert groups[0]['targets'] == ('types',)
+    assert groups[0]['globs'] == ['*.fidl']
+
+
+def test_rewritten_file_keeps_its_permissions(tmp_path):
+    out_file = tmp_path / "out.h"
+    out_file.write_text("old\n")
+    out_file.chmod(0o640)
+    assert pyfranca_cpp.write_result_file("new\n", str(out_file))
+    assert out_file.read_text() == "new\n"
+    assert out_file.stat().st_mode & 0o7777 == 0o640
+
+
+@pytest.mark.parametrize('mode', [dict(pipeline=True), dict(low_memory=True)])
+def test_streamed_outputs_are_written_once(tmp_path, mode):
+    files = small_corpus(tmp_path)
+    archive = str(tmp_path / "out.tar")
+    sink = ArchiveSink(archive)
+    Generator(str(tmp_path / "out"), formatter='none', jobs=2, sink=sink, **mode).generate(files)
+    sink.close()
+    with tarfile.open(archive) as tar:
+        names = tar.getnames()
+    assert len(names) == len(set(names))
+    assert "Types0.types.h" in names
+
+
+def test_dependency_graph_covers_skipped_and_unrendered_types(tmp_path):
+    files = small_corpus(tmp_path)
+    graphs = []
+    # The second run finds everything up to date, the third renders no types
+    for targets in ('types,interface', 'types,interface', 'interface'):
+        graph = tmp_path / f"graph{len(graphs)}.json"
+        assert pyfranca_cpp.main(['--formatter', 'none', '-o', str(tmp_path / "out"),
+                                  '--targets', targets, '--dependency-graph', str(graph)] + files) == 0
+        graphs.append(json.loads(graph.read_text()))
+    assert "bench.types0.Types0.T0S0" in graphs[0]
+    assert graphs[1] == graphs[0]
+    assert graphs[2] == graphs[0]
+
+
+def test_model_helpers_work_without_a_generator():
+    # pyfranca is imported on first use, not only by Generator()
+    script = ("import pyfranca_cpp; from pyfranca import ast; "
+              "assert pyfranca_cpp.is_array(ast.Array('A', ast.UInt8())); "
+              "assert pyfranca_cpp.is_reference(ast.Reference('T'))")
+    subprocess.run([sys.executable, "-c", script], check=True,
+                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_unreadable_inputs_are_reported_per_file(tmp_path, jobs):
+    files = small_corpus(tmp_path)
+    (tmp_path / "latin1.fidl").write_bytes(b"package \xe4\n")
+    inputs = [str(tmp_path / "missing.fidl"), str(tmp_path / "latin1.fidl"), files[0]]
+    sink = MemorySink()
+    results = Generator(str(tmp_path / "out"), formatter='none', jobs=jobs, sink=sink).generate(inputs)
+    assert ["can't read" in " ".join(job.errors) for job in results] == [True, True, False]
+    assert "iIface0.h" in sink.files
+
+
+def test_new_file_gets_permissions_from_umask(tmp_path):
+    out_file = tmp_path / "new.h"
+    umask = os.umask(0o027)
+    try:
+        assert pyfranca_cpp.write_result_file("new\n", str(out_file))
+    finally:
+        os.umask(umask)
+    assert out_file.stat().st_mode & 0o7777 == 0o640
+    assert [path.name for path in tmp_path.iterdir()] == ["new.h"]
+
+
+def dependency_index(*edges):
+    index = DependencyIndex()
+    for referencer, referenced in edges:
+        index.add(referencer, referenced)
+    return index
+
+
+def rendered(*names):
+    return [(name, f"<{name}>") for name in names]
+
+
+def test_reorder_types_keeps_order_of_independent_types():
+    ordered = reorder_types(rendered("A", "B", "C", "D"), dependency_index(("A", "C"), ("B", "Unknown")))
+    assert [name for name, _ in ordered] == ["B", "C", "A", "D"]
+
+
+def test_reorder_types_ignores_self_references():
+    ordered = reorder_types(rendered("A", "B"), dependency_index(("A", "A"), ("B", "A")))
+    assert [name for name, _ in ordered] == ["A", "B"]
+
+
+def test_reorder_types_reports_the_cycle_members():
+    index = dependency_index(("A", "B"), ("B", "C"), ("C", "A"), ("D", "A"), ("E", "F"), ("F", "E"))
+    with pytest.raises(CircularReferenceError) as error_info:
+        reorder_types(rendered("A", "B", "C", "D", "E", "F", "G"), index)
+    assert error_info.value.cycles == [["A", "B", "C"], ["E", "F"]]
+
+
+def test_strongly_connected_components():
+    graph = {"A": ["B"], "B": ["A", "C"], "C": [], "D": ["D"]}
+    assert sorted(sorted(component) for component in strongly_connected_components(graph)) == \
+        [["A", "B"], ["C"], ["D"]]
+
+
+def write_fidl(path, text):
+    path.write_text(text)
+    return str(path)
+
+
+def test_validate_model_reports_locations(tmp_path):
+    write_fidl(tmp_path / "a.fidl", """package test.a
+
+typeCollection A {
+    struct Loop1 {
+        Loop2 next
+    }
+
+    struct Loop2 {
+        Loop1 back
+    }
+
+    struct Shared {
+        UInt8 value
+    }
+}
+""")
+    importer = write_fidl(tmp_path / "b.fidl", """package test.b
+
+import test.a.A.* from "a.fidl"
+
+typeCollection B {
+    struct Shared {
+        UInt16 value
+    }
+}
+""")
+    unresolved = write_fidl(tmp_path / "c.fidl", """package test.c
+
+typeCollection C {
+    struct Broken {
+        Missing field
+    }
+}
+""")
+    generator = Generator(str(tmp_path / "out"), formatter='none', sink=MemorySink())
+    errors = [job.errors for job in generator.generate([importer, unresolved])]
+    a_file = tmp_path / "a.fidl"
+    assert errors == [
+        [f"{a_file}:12: type 'Shared' of A is also defined in B ({tmp_path / 'b.fidl'}:6)",
+         f"{a_file}:4: circular type reference: test.a.A.Loop1 <-> test.a.A.Loop2"],
+        [f"{unresolved}:5: Unresolved reference 'Missing'."]]
+
+
+def cached_generator(tmp_path, template_dir):
+    generator = Generator(str(tmp_path / "out"), template_dir=str(template_dir), formatter='none')
+    generator.cache = BuildCache(str(tmp_path / "out" / pyfranca_cpp.BUILD_CACHE_FILE),
+                                 generator.template_states(), generator.targets)
+    return generator
+
+
+def test_build_cache_marks_only_targets_of_a_changed_template(tmp_path):
+    files = small_corpus(tmp_path / "fidl")
+    template_dir = tmp_path / "override"
+    cached_generator(tmp_path, template_dir).generate(files[:1])
+    assert cached_generator(tmp_path, template_dir).cache.stale_targets(files[0]) == {}
+
+    (template_dir / "templates").mkdir(parents=True)
+    with open(os.path.join(pyfranca_cpp.basedir, "templates", "unittest.tpl"), encoding="utf8") as in_file:
+        original = in_file.read()
+    (template_dir / "templates" / "unittest.tpl").write_text("{# changed #}" + original)
+    stale = cached_generator(tmp_path, template_dir).cache.stale_targets(files[0])
+    assert list(stale) == ["mock"]
+
+
+def test_python_format_indents_the_lines_clean_splits():
+    content = "class iX\n{\n    public:\n    iX (){};\n    virtual ~iX () {};\n};\n"
+    result = pyfranca_cpp.format_output("iX.h", content, 'python', None, pyfranca_cpp.TimingReport())
+    assert result == "class iX\n{\n  public:\n    iX()\n    {};\n    virtual ~iX() {};\n};\n"
+
+
+def test_invalid_source_date_epoch_is_rejected_by_the_api(tmp_path, monkeypatch):
+    files = small_corpus(tmp_path)
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1.5e9')
+    with pytest.raises(ValueError, match="SOURCE_DATE_EPOCH must be a number"):
+        Generator(str(tmp_path / "out"), formatter='none', sink=MemorySink()).generate(files)
+    with pytest.raises(ValueError, match="SOURCE_DATE_EPOCH must be a number"):
+        ArchiveSink(str(tmp_path / "out.tar"))
+    assert not (tmp_path / "out.tar").exists()